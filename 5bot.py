@@ -1,20 +1,23 @@
 # 5bot.py — HR-бот: ES/UA, Google Sheet (FAQ / Forms / Profiles) + Email OTP
-import os, re, csv, html, json, asyncio, logging, urllib.parse, io, hashlib, unicodedata
-import time, secrets, smtplib
+import os, re, csv, html, json, asyncio, logging, urllib.parse, io, hashlib, unicodedata, contextlib, sqlite3
+import time, secrets, smtplib, math, heapq, tempfile, inspect, hmac, gzip, calendar, bisect, functools, contextvars
+import cProfile, marshal
 from email.message import EmailMessage
-from io import StringIO, BytesIO
+from http import HTTPStatus
 from pathlib import Path
-from typing import Dict, List, Any, Optional
+from typing import Dict, List, Any, Optional, Iterator, Callable
+from collections import OrderedDict
 
 import aiosqlite
 import httpx
 from dotenv import load_dotenv
 
 from telegram import Update, InlineKeyboardButton, InlineKeyboardMarkup, WebAppInfo, InputFile
-from telegram.constants import ChatAction
+from telegram.error import BadRequest, RetryAfter
 from telegram.ext import (
     Application, CommandHandler, MessageHandler, CallbackQueryHandler,
-    ConversationHandler, ContextTypes, filters
+    ConversationHandler, ContextTypes, BaseUpdateProcessor, BasePersistence, PersistenceInput,
+    BaseRateLimiter, filters
 )
 
 # ---------- базовая настройка ----------
@@ -31,13 +34,58 @@ BOT_TOKEN = os.getenv("BOT_TOKEN")
 ADMIN_IDS = [int(x.strip()) for x in (os.getenv("ADMIN_IDS") or "").split(",") if x.strip()]
 
 WEBAPP_URL = os.getenv("WEBAPP_URL") or ""
+
+# Режим получения апдейтов: polling (по умолчанию, для локальной разработки) или webhook
+BOT_MODE = (os.getenv("BOT_MODE") or "polling").strip().lower()
+DROP_PENDING_UPDATES = (os.getenv("DROP_PENDING_UPDATES","true").lower() == "true")
+WEBHOOK_URL    = os.getenv("WEBHOOK_URL") or ""        # публичный адрес за балансировщиком, https://bot.example.com
+WEBHOOK_LISTEN = os.getenv("WEBHOOK_LISTEN") or "0.0.0.0"
+WEBHOOK_PORT   = int(os.getenv("WEBHOOK_PORT") or "8443")
+WEBHOOK_PATH   = (os.getenv("WEBHOOK_PATH") or "telegram").strip("/")
+WEBHOOK_SECRET = os.getenv("WEBHOOK_SECRET") or ""     # пусто — выводится из BOT_TOKEN (одинаков у всех инстансов)
+WEBHOOK_CERT   = os.getenv("WEBHOOK_CERT") or ""       # TLS прямо в боте; при терминации на балансировщике — пусто
+WEBHOOK_KEY    = os.getenv("WEBHOOK_KEY") or ""
+HEALTH_LISTEN  = os.getenv("HEALTH_LISTEN") or "0.0.0.0"
+HEALTH_PORT    = int(os.getenv("HEALTH_PORT") or ("8080" if BOT_MODE == "webhook" else "0"))  # 0 = off; /healthz, /metrics
 SYNC_INTERVAL_MIN = int(os.getenv("SYNC_INTERVAL_MIN") or "0")  # 0 = off
+EXPORT_CHUNK     = int(os.getenv("EXPORT_CHUNK") or "1000")                       # строк за один запрос при экспорте
+EXPORT_SPOOL_MAX = int(os.getenv("EXPORT_SPOOL_MAX") or str(8 * 1024 * 1024))   # больше — файл экспорта уходит на диск
+IMPORT_CHUNK        = int(os.getenv("IMPORT_CHUNK") or "1000")        # строк на одну транзакцию при /import_profiles
+IMPORT_PROGRESS_SEC = float(os.getenv("IMPORT_PROGRESS_SEC") or "2")  # не чаще — правка сообщения с прогрессом
+IMPORT_ERRORS_SHOWN = 10
+PROFILE_DEFAULT_SEC = 30    # /profile без аргумента
+PROFILE_MAX_SEC     = int(os.getenv("PROFILE_MAX_SEC") or "300")
+PROFILE_TOP         = 25    # строк в текстовой сводке
+PERSIST_INTERVAL_SEC = float(os.getenv("PERSIST_INTERVAL_SEC") or "5")  # как часто user_data / диалоги сбрасываются в БД
+MAX_CONCURRENT_UPDATES = int(os.getenv("MAX_CONCURRENT_UPDATES") or "64")  # одновременно обрабатываемых апдейтов (разных пользователей)
+# Исходящие запросы к Bot API (лимиты Telegram: ~30 сообщений/с всего, ~1/с в чат, 20/мин в группу)
+RATE_GLOBAL_PER_SEC = float(os.getenv("RATE_GLOBAL_PER_SEC") or "30")   # 0 = без общего лимита
+RATE_CHAT_PER_SEC   = float(os.getenv("RATE_CHAT_PER_SEC") or "1")      # 0 = без лимита на чат
+RATE_CHAT_BURST     = float(os.getenv("RATE_CHAT_BURST") or "3")        # столько запросов в чат можно подряд без паузы
+RATE_GROUP_PER_MIN  = float(os.getenv("RATE_GROUP_PER_MIN") or "20")
+RATE_MAX_RETRIES    = int(os.getenv("RATE_MAX_RETRIES") or "3")         # повторов после 429 (RetryAfter)
+
+# Поиск по FAQ в свободном тексте: keyword = подстрока ключевого слова, ranked = BM25 по индексу
+FAQ_SEARCH_MODE       = (os.getenv("FAQ_SEARCH_MODE") or "keyword").strip().lower()
+FAQ_TOP_K             = int(os.getenv("FAQ_TOP_K") or "3")
+FAQ_MIN_SCORE         = float(os.getenv("FAQ_MIN_SCORE") or "0.5")
+FAQ_AMBIGUOUS_RATIO   = float(os.getenv("FAQ_AMBIGUOUS_RATIO") or "0.75")  # 2-й результат ≥ 75% 1-го → кнопки
+
+# «⏳ Cargando…» показываем, только если экран готовится дольше порога
+LOADER_THRESHOLD_MS = int(os.getenv("LOADER_THRESHOLD_MS") or "400")
 
 GOOGLE_SHEET_EDIT_URL = os.getenv("GOOGLE_SHEET_EDIT_URL") or ""
 # Поддерживаем и старое имя переменной:
 GOOGLE_FAQ_GID = os.getenv("GOOGLE_FAQ_GID") or os.getenv("GOOGLE_MAIN_GID") or ""
 GOOGLE_FORMS_GID = os.getenv("GOOGLE_FORMS_GID") or ""
 GOOGLE_PROFILES_GID = os.getenv("GOOGLE_PROFILES_GID") or ""
+SHEET_FETCH_RETRIES = int(os.getenv("SHEET_FETCH_RETRIES") or "3")        # попыток на каждый URL
+SHEET_RETRY_BASE_SEC = float(os.getenv("SHEET_RETRY_BASE_SEC") or "0.5")  # пауза 0.5, 1, 2… сек
+SHEET_STREAM_CHUNK = 64 * 1024
+SHEET_SPOOL_MAX = int(os.getenv("SHEET_SPOOL_MAX") or str(4 * 1024 * 1024))  # больше — спул уходит на диск
+PROFILE_SYNC_CHUNK = int(os.getenv("PROFILE_SYNC_CHUNK") or "1000")
+PROFILE_PRUNE_MAX_SHARE = float(os.getenv("PROFILE_PRUNE_MAX_SHARE") or "0.2")  # вкладка сократилась сильнее (и больше чем
+PROFILE_PRUNE_MIN_ROWS = int(os.getenv("PROFILE_PRUNE_MIN_ROWS") or "5")          # на столько строк) — не удалять до /refresh force
 
 # SMTP / OTP
 SMTP_HOST = os.getenv("SMTP_HOST") or ""
@@ -46,6 +94,11 @@ SMTP_USER = os.getenv("SMTP_USER") or ""
 SMTP_PASS = (os.getenv("SMTP_PASS") or "").strip()
 SMTP_FROM = os.getenv("SMTP_FROM") or (f"HR Assistant <{SMTP_USER}>" if SMTP_USER else "HR Assistant <no-reply@example.com>")
 SMTP_USE_SSL = (os.getenv("SMTP_USE_SSL","true").lower() == "true")
+SMTP_STARTTLS = (os.getenv("SMTP_STARTTLS","true").lower() == "true")  # без SSL; false — локальная заглушка без TLS
+SMTP_WORKERS  = int(os.getenv("SMTP_WORKERS") or "2")      # параллельных SMTP-сессий
+SMTP_IDLE_SEC = int(os.getenv("SMTP_IDLE_SEC") or "60")    # после такого простоя сессия проверяется NOOP
+EMAIL_MAX_ATTEMPTS   = int(os.getenv("EMAIL_MAX_ATTEMPTS") or "5")
+EMAIL_RETRY_BASE_SEC = float(os.getenv("EMAIL_RETRY_BASE_SEC") or "2")   # пауза 2, 4, 8… сек
 
 OTP_TTL_MIN      = int(os.getenv("OTP_TTL_MIN") or "10")
 OTP_ATTEMPTS_MAX = int(os.getenv("OTP_ATTEMPTS_MAX") or "5")
@@ -89,32 +142,36 @@ TX: Dict[str, Dict[str, str]] = {
                "/cancel — cancelar formulario\n"
                "/myid — tu Telegram ID\n"
                "/stats — estadísticas (admin)\n"
-               "/users [offset] [limit] — lista (admin)\n"
-               "/export_users — exportar CSV (admin)\n"
+               "/users [limit] — lista, ◀ ▶ para paginar (admin)\n"
+               "/export_users [7d | 2024-05-01] [gz] — exportar CSV (admin)\n"
+               "/export_forms <form> [desde] [hasta] [gz] — exportar solicitudes CSV (admin)\n"
                "/setprofile <login> <json> — guardar perfil (admin)\n"
                "/import_profiles — importar CSV de perfiles (admin)\n"
                "/whoami — ver tu perfil\n"
                "/logout — desvincular login\n"
                "/verify — verificación\n"
                "/resend — reenviar código\n"
-               "/refresh — recargar Google Sheet (admin)\n"
-               "/dump_profile <login> — ver perfil crudo (admin)\n"),
+               "/refresh [force] — recargar Google Sheet; force: releer todo y aplicar bajas retenidas (admin)\n"
+               "/dump_profile <login> — ver perfil crudo (admin)\n"
+               "/profile [seg] — perfilar el bot N segundos (admin)\n"),
         "uk": ("Команди:\n"
                "/start — меню\n"
                "/help — допомога\n"
                "/cancel — скасувати форму\n"
                "/myid — ваш Telegram ID\n"
                "/stats — статистика (адмін)\n"
-               "/users [offset] [limit] — список (адмін)\n"
-               "/export_users — експорт CSV (адмін)\n"
+               "/users [limit] — список, ◀ ▶ для гортання (адмін)\n"
+               "/export_users [7d | 2024-05-01] [gz] — експорт CSV (адмін)\n"
+               "/export_forms <form> [від] [до] [gz] — експорт заявок CSV (адмін)\n"
                "/setprofile <login> <json> — зберегти профіль (адмін)\n"
                "/import_profiles — імпорт CSV профілів (адмін)\n"
                "/whoami — показати профіль\n"
                "/logout — відʼєднати логін\n"
                "/verify — верифікація\n"
                "/resend — надіслати код знову\n"
-               "/refresh — перезавантажити Google Sheet (адмін)\n"
-               "/dump_profile <login> — подивитись сирий профіль (адмін)\n")
+               "/refresh [force] — перезавантажити Google Sheet; force: перечитати все й застосувати утримані видалення (адмін)\n"
+               "/dump_profile <login> — подивитись сирий профіль (адмін)\n"
+               "/profile [сек] — профілювання бота N секунд (адмін)\n")
     },
     "menu_main": {"es": "Menú principal:", "uk": "Головне меню:"},
     "menu_quick_title": {"es": "⚡ <b>Tópicos rápidos</b>\nElige una opción:", "uk": "⚡ <b>Швидкі теми</b>\nОберіть пункт:"},
@@ -157,117 +214,249 @@ def _split_keywords(s: str) -> List[str]:
     return [p for p in parts if p]
 
 # ---------- ДИНАМИКА из Google Sheet ----------
-KB_ES: Dict[str, Dict[str, Any]] = {}
-KB_UK: Dict[str, Dict[str, Any]] = {}
-FORMS_ES: Dict[str, Dict[str, Any]] = {}
-FORMS_UK: Dict[str, Dict[str, Any]] = {}
-
-def kb_for_lang(lang: str): return KB_ES if lang == "es" else KB_UK
-def forms_for_lang(lang: str): return FORMS_ES if lang == "es" else FORMS_UK
-
-async def fetch_rows_from_sheet(edit_url: str, override_gid: Optional[str]) -> List[dict]:
-    if not edit_url:
-        raise RuntimeError("GOOGLE_SHEET_EDIT_URL is empty")
+# Контент живёт в неизменяемом снимке CONTENT (см. ContentSnapshot ниже).
+# Хендлер берёт snap = CONTENT один раз и работает с ним до конца апдейта.
+def kb_for_lang(lang: str, snap: Optional["ContentSnapshot"] = None) -> Dict[str, Dict[str, Any]]:
+    return (snap or CONTENT).kb[lang if lang in LANGS else "uk"]
+
+def forms_for_lang(lang: str, snap: Optional["ContentSnapshot"] = None) -> Dict[str, Dict[str, Any]]:
+    return (snap or CONTENT).forms[lang if lang in LANGS else "uk"]
+
+# Один долгоживущий HTTP-клиент на приложение: keep-alive между синками и вкладками
+# (без нового TLS-рукопожатия на каждый запрос), HTTP/2 — если установлен пакет h2.
+try:
+    import h2  # noqa: F401
+    _HTTP2 = True
+except ImportError:
+    _HTTP2 = False
+
+_HTTP: Optional[httpx.AsyncClient] = None
+
+def get_http() -> httpx.AsyncClient:
+    global _HTTP
+    if _HTTP is None:
+        _HTTP = httpx.AsyncClient(
+            timeout=25, follow_redirects=True, http2=_HTTP2,
+            limits=httpx.Limits(max_connections=10, max_keepalive_connections=10, keepalive_expiry=120),
+            headers={"User-Agent": "Mozilla/5.0", "Accept": "text/csv,*/*;q=0.1", "Cache-Control": "no-cache"},
+        )
+    return _HTTP
+
+async def close_http():
+    global _HTTP
+    if _HTTP is not None:
+        client, _HTTP = _HTTP, None
+        await client.aclose()
+
+def _retryable(e: Exception) -> bool:
+    if isinstance(e, httpx.HTTPStatusError):
+        return e.response.status_code == 429 or e.response.status_code >= 500
+    return isinstance(e, httpx.TransportError)
+
+async def _download_with_retries(url: str, headers: dict) -> tuple:
+    """Качает тело потоком в SpooledTemporaryFile (в памяти до SHEET_SPOOL_MAX, дальше
+    на диске), попутно считая хэш. Возвращает (response, spool, hash); spool = None при 304."""
+    for attempt in range(SHEET_FETCH_RETRIES):
+        spool = tempfile.SpooledTemporaryFile(max_size=SHEET_SPOOL_MAX)
+        try:
+            async with get_http().stream("GET", url, headers=headers) as r:
+                if r.status_code == 304:
+                    spool.close()
+                    return r, None, ""
+                r.raise_for_status()
+                h = hashlib.blake2b(digest_size=16)
+                async for chunk in r.aiter_bytes(SHEET_STREAM_CHUNK):
+                    h.update(chunk)
+                    spool.write(chunk)
+            spool.seek(0)
+            return r, spool, h.hexdigest()
+        except Exception as e:
+            spool.close()
+            if attempt + 1 >= SHEET_FETCH_RETRIES or not _retryable(e):
+                raise
+            delay = SHEET_RETRY_BASE_SEC * (2 ** attempt)
+            log.warning(f"[gsheet] {url}: {e}; retry in {delay:.1f}s")
+            await asyncio.sleep(delay)
+
+def _iter_csv_rows(spool) -> Iterator[dict]:
+    """Строки CSV по одной прямо из спула — вкладка целиком в памяти не материализуется."""
+    try:
+        text = io.TextIOWrapper(spool, encoding="utf-8-sig", errors="replace", newline="")
+        yield from csv.DictReader(text)
+    finally:
+        spool.close()
+
+# Состояние синка по вкладкам: ETag / Last-Modified последнего ответа, хэш тела
+# и уже разобранный контент (FAQ / формы; профили уже лежат в БД). Неизменённая
+# вкладка (304 или тот же хэш) повторно не парсится. Новое состояние фиксируется
+# только после успешного применения.
+_TAB_STATE: Dict[str, dict] = {}
+
+def _sheet_csv_urls(edit_url: str, override_gid: Optional[str]) -> tuple:
     try:
         u = urllib.parse.urlparse(edit_url)
         parts = [p for p in u.path.split("/") if p]
         doc_id = parts[2] if len(parts) >= 3 else parts[-1]
         gid = (override_gid or (urllib.parse.parse_qs(u.query).get("gid") or ["0"])[0])
-        urls = [
+        return gid, [
             f"https://docs.google.com/spreadsheets/d/{doc_id}/export?format=csv&gid={gid}",
             f"https://docs.google.com/spreadsheets/d/{doc_id}/gviz/tq?tqx=out:csv&gid={gid}",
         ]
     except Exception:
-        urls = [edit_url]
+        return override_gid or "", [edit_url]
+
+async def fetch_rows_from_sheet(edit_url: str, override_gid: Optional[str], force: bool = False) -> tuple:
+    """Возвращает (rows, meta): rows — ленивый итератор строк CSV,
+    None — если вкладка не изменилась с прошлого синка. force — качать и разбирать заново."""
+    if not edit_url:
+        raise RuntimeError("GOOGLE_SHEET_EDIT_URL is empty")
+    tab, urls = _sheet_csv_urls(edit_url, override_gid)
+    prev = {} if force else (_TAB_STATE.get(tab) or {})
 
-    raw = None
+    spool = None
+    meta: dict = {}
     last_err = None
     for url in urls:
         log.info(f"[gsheet] try CSV URL: {url}")
+        headers = {}
+        if prev.get("url") == url and "part" in prev:
+            if prev.get("etag"):          headers["If-None-Match"] = prev["etag"]
+            if prev.get("last_modified"): headers["If-Modified-Since"] = prev["last_modified"]
         try:
-            async with httpx.AsyncClient(
-                timeout=25, follow_redirects=True,
-                headers={"User-Agent": "Mozilla/5.0", "Accept": "text/csv,*/*;q=0.1", "Cache-Control": "no-cache"},
-            ) as client:
-                r = await client.get(url)
-                r.raise_for_status()
-                raw = r.text
-                if raw and raw.strip():
-                    break
+            with SHEET_FETCH_SECONDS.timer(tab):
+                r, spool, digest = await _download_with_retries(url, headers)
+            if spool is None:
+                SHEET_FETCHES.inc(tab, "not_modified")
+                log.info(f"[gsheet] tab {tab}: not modified")
+                return None, prev
+            size = spool.seek(0, io.SEEK_END); spool.seek(0)
+            if size:
+                meta = {
+                    "tab": tab, "url": url,
+                    "etag": r.headers.get("ETag"),
+                    "last_modified": r.headers.get("Last-Modified"),
+                    "hash": digest,
+                }
+                break
+            spool.close(); spool = None
         except Exception as e:
             last_err = e
+            SHEET_FETCHES.inc(tab, "error")
             log.error(f"[gsheet] fetch failed for {url}: {e}")
-    if not raw:
+    if spool is None:
         raise RuntimeError(f"CSV not loaded. Last error: {last_err}")
 
-    reader = csv.DictReader(StringIO(raw))
-    return list(reader)
-
-async def fetch_sheet_configs():
-    rows_faq = []
-    rows_forms = []
-    rows_profiles = []
-    if GOOGLE_FAQ_GID:
-        rows_faq = await fetch_rows_from_sheet(GOOGLE_SHEET_EDIT_URL, GOOGLE_FAQ_GID)
-    if GOOGLE_FORMS_GID:
-        rows_forms = await fetch_rows_from_sheet(GOOGLE_SHEET_EDIT_URL, GOOGLE_FORMS_GID)
-    if GOOGLE_PROFILES_GID:
-        rows_profiles = await fetch_rows_from_sheet(GOOGLE_SHEET_EDIT_URL, GOOGLE_PROFILES_GID)
-
-    if not any([rows_faq, rows_forms, rows_profiles]):
-        rows_faq = await fetch_rows_from_sheet(GOOGLE_SHEET_EDIT_URL, None)
-
-    KB_es, KB_uk = {}, {}
-    FORMS_es_new, FORMS_uk_new = {}, {}
-    PROFILES: Dict[str, dict] = {}
-
-    def ingest_row(row: dict):
-        typ  = (row.get("type") or "").strip().lower()
-        lang = (row.get("lang") or "").strip().lower()
-        key  = (row.get("key") or row.get("login") or "").strip()
+    if meta["hash"] == prev.get("hash") and "part" in prev:
+        spool.close()
+        SHEET_FETCHES.inc(tab, "unchanged")
+        log.info(f"[gsheet] tab {tab}: unchanged (same hash)")
+        return None, {**meta, "part": prev["part"]}
+    SHEET_FETCHES.inc(tab, "downloaded")
+    return _iter_csv_rows(spool), meta
+
+def _new_tab_part() -> dict:
+    return {"kb": {"es": {}, "uk": {}}, "forms": {"es": {}, "uk": {}}, "rows": 0}
+
+def _ingest_row(part: dict, row: dict) -> Optional[dict]:
+    """Раскладывает FAQ/формы в part; строку профиля возвращает вызывающему."""
+    typ  = (row.get("type") or "").strip().lower()
+    lang = (row.get("lang") or "").strip().lower()
+    key  = (row.get("key") or row.get("login") or "").strip()
+    part["rows"] += 1
+
+    if typ == "faq" and lang in ("es", "uk") and key:
+        title    = _clean_text(row.get("title") or "")
+        text     = _clean_text(row.get("text") or "")
+        keywords = _split_keywords(row.get("keywords") or "")
+        part["kb"][lang][key] = {
+            "title": title or key,
+            "keywords": keywords if keywords else [key],
+            "response": text or title or key
+        }
 
+    elif typ == "form" and lang in ("es", "uk") and key:
         title      = _clean_text(row.get("title") or "")
-        text       = _clean_text(row.get("text") or "")
         fields_str = _clean_text(row.get("fields") or "")
         icon       = (row.get("icon") or "").strip() or "📝"
-        keywords   = _split_keywords(row.get("keywords") or "")
         url        = (row.get("url") or "").strip()
+        part["forms"][lang][key] = {
+            "name": title or key,
+            "fields": _split_fields(fields_str),
+            "icon": icon or "📝",
+            "url": url if url else None
+        }
+
+    elif typ == "profile" and key:
+        return {
+            "login": key,
+            "full_name": _clean_text(row.get("full_name") or ""),
+            "position":  _clean_text(row.get("position")  or ""),
+            "team":      _clean_text(row.get("department") or row.get("team") or ""),
+            "email":     (row.get("email") or "").strip(),
+            "phone":     (row.get("phone") or "").strip(),
+            "manager":   _clean_text(row.get("manager") or ""),
+            "vacation_left": int((row.get("vacation_left") or "0").strip() or 0),
+            "salary_usd":   int((row.get("salary_usd") or "0").strip() or 0),
+            "extra_json": None,
+        }
+    return None
 
-        if typ == "faq" and lang in ("es", "uk") and key:
-            entry = {
-                "title": title or key,
-                "keywords": keywords if keywords else [key],
-                "response": text or title or key
-            }
-            (KB_es if lang == "es" else KB_uk)[key] = entry
-
-        elif typ == "form" and lang in ("es", "uk") and key:
-            entry = {
-                "name": title or key,
-                "fields": _split_fields(fields_str),
-                "icon": icon or "📝",
-                "url": url if url else None
-            }
-            (FORMS_es_new if lang == "es" else FORMS_uk_new)[key] = entry
-
-        elif typ == "profile" and key:
-            login = key
-            PROFILES[login] = {
-                "login": login,
-                "full_name": _clean_text(row.get("full_name") or ""),
-                "position":  _clean_text(row.get("position")  or ""),
-                "team":      _clean_text(row.get("department") or row.get("team") or ""),
-                "email":     (row.get("email") or "").strip(),
-                "phone":     (row.get("phone") or "").strip(),
-                "manager":   _clean_text(row.get("manager") or ""),
-                "vacation_left": int((row.get("vacation_left") or "0").strip() or 0),
-                "salary_usd":   int((row.get("salary_usd") or "0").strip() or 0),
-                "extra_json": None,
-            }
-
-    for r in rows_faq:       ingest_row(r)
-    for r in rows_forms:     ingest_row(r)
-    for r in rows_profiles:  ingest_row(r)
+async def _load_tab(run: int, gid: Optional[str], force: bool = False) -> tuple:
+    """(part, tab_state, changed) для одной вкладки. Профили уходят в profile_stage пачками
+    по PROFILE_SYNC_CHUNK по мере разбора, так что память не растёт с размером вкладки."""
+    rows, meta = await fetch_rows_from_sheet(GOOGLE_SHEET_EDIT_URL, gid, force)
+    if rows is None:
+        return meta["part"], meta, False
+    part = _new_tab_part()
+    batch: List[dict] = []
+    with SHEET_PARSE_SECONDS.timer(meta["tab"]):
+        for r in rows:
+            p = _ingest_row(part, r)
+            if p is not None:
+                batch.append(p)
+                if len(batch) >= PROFILE_SYNC_CHUNK:
+                    await stage_profiles(run, meta["tab"], batch); batch = []
+        if batch:
+            await stage_profiles(run, meta["tab"], batch)
+    SHEET_ROWS.set(part["rows"], meta["tab"])
+    return part, {**meta, "part": part}, True
+
+async def fetch_sheet_configs(force: bool = False):
+    """Собирает контент из вкладок и синхронизирует профили. Возвращает None,
+    если ни одна вкладка не изменилась, иначе (KB_es, KB_uk, FORMS_es, FORMS_uk, profile_counts, tab_states).
+    force — перечитать все вкладки и удалить пропавшие логины в обход защиты merge_profiles."""
+    run = await profile_stage_begin()
+    try:
+        # вкладки качаются параллельно, у каждой свой фолбэк export → gviz. Если одна упала,
+        # остальные отменяются и дожидаются до удаления прогона: иначе они допишут строки
+        # в profile_stage уже после profile_stage_drop (и после снятия _SHEET_SYNC_LOCK)
+        gids = [gid for gid in (GOOGLE_FAQ_GID, GOOGLE_FORMS_GID, GOOGLE_PROFILES_GID) if gid]
+        tasks = [asyncio.create_task(_load_tab(run, gid, force)) for gid in gids]
+        try:
+            loaded = list(await asyncio.gather(*tasks))
+        except BaseException:
+            for t in tasks:
+                t.cancel()
+            await asyncio.gather(*tasks, return_exceptions=True)
+            raise
+
+        if not any(part["rows"] for part, _, _ in loaded):
+            loaded.append(await _load_tab(run, None, force))
+
+        if not any(changed for _, _, changed in loaded):
+            return None
+
+        # удалять пропавшие логины можно только по вкладкам, перечитанным целиком и непустым
+        reread = [st["tab"] for part, st, changed in loaded if changed and part["rows"]]
+        counts = await merge_profiles(run, reread, force)
+    finally:
+        await profile_stage_drop(run)
+
+    KB_es, KB_uk = {}, {}
+    FORMS_es_new, FORMS_uk_new = {}, {}
+    for part, _, _ in loaded:
+        KB_es.update(part["kb"]["es"]);          KB_uk.update(part["kb"]["uk"])
+        FORMS_es_new.update(part["forms"]["es"]); FORMS_uk_new.update(part["forms"]["uk"])
 
     # дефолты на случай пустых таблиц
     if not FORMS_es_new and not FORMS_uk_new:
@@ -277,8 +466,9 @@ async def fetch_sheet_configs():
         KB_es.update({"vacaciones": {"title":"Vacaciones","keywords":["vacaciones"], "response":"📅 **Vacaciones**: 24 días."}})
         KB_uk.update({"відпустка": {"title":"Відпустка","keywords":["відпустка"], "response":"📅 **Відпустка**: 24 дні."}})
 
-    log.info(f"[gsheet] built: KB_es={len(KB_es)} KB_uk={len(KB_uk)} FORMS_es={len(FORMS_es_new)} FORMS_uk={len(FORMS_uk_new)} PROFILES={len(PROFILES)}")
-    return KB_es, KB_uk, FORMS_es_new, FORMS_uk_new, PROFILES
+    tab_states = {st["tab"]: st for _, st, _ in loaded}
+    log.info(f"[gsheet] built: KB_es={len(KB_es)} KB_uk={len(KB_uk)} FORMS_es={len(FORMS_es_new)} FORMS_uk={len(FORMS_uk_new)} profiles={counts}")
+    return KB_es, KB_uk, FORMS_es_new, FORMS_uk_new, counts, tab_states
 
 # ---------- профиль ----------
 def profile_card(lang: str, p: dict) -> str:
@@ -311,28 +501,37 @@ def profile_card(lang: str, p: dict) -> str:
     return f"{title}\n" + card(p.get("login","—"), lines) + f"\n\n{note}"
 
 # ---------- безопасные callback токены для FAQ ----------
-CB_MAP = {"es": {}, "uk": {}}
+# token = md5(key)[:10] — стабилен между перезагрузками, так что кнопки в старых
+# сообщениях продолжают работать. Карты token <-> key лежат в снимке контента.
+def _cb_token(key: str) -> str:
+    return hashlib.md5(key.encode("utf-8")).hexdigest()[:10]
 
 # ---------- навигация: клавиатуры ----------
+# Разметка, зависящая от контента (быстрые темы, формы), собирается один раз вместе
+# со снимком контента; статичные меню кэшируются по варианту. Клик по меню только
+# достаёт готовый InlineKeyboardMarkup — без сортировок и хэширования.
+_STATIC_KB: Dict[tuple, InlineKeyboardMarkup] = {}
+
 def lang_toggle_row(lang: str) -> List[InlineKeyboardButton]:
     return [InlineKeyboardButton("🇺🇦 UA", callback_data="lang_uk")] if lang == "es" else [InlineKeyboardButton("🇪🇸 ES", callback_data="lang_es")]
 
 def kb_back_to(target: str, lang: str) -> InlineKeyboardMarkup:
     # target ∈ {"main","menu_quick","menu_forms"}
-    title = {"main": ("⬅️ Atrás" if lang=="es" else "⬅️ Назад"),
-             "menu_quick": ("⬅️ Atrás" if lang=="es" else "⬅️ Назад"),
-             "menu_forms": ("⬅️ Atrás" if lang=="es" else "⬅️ Назад")}[target]
-    return InlineKeyboardMarkup([
-        [InlineKeyboardButton(title, callback_data=f"back_to:{target}")],
-        lang_toggle_row(lang)
-    ])
-
-async def kb_main_for(user_id: int) -> InlineKeyboardMarkup:
-    lang = await get_pref_lang(user_id)
+    kb = _STATIC_KB.get(("back", target, lang))
+    if kb is None:
+        title = {"main": ("⬅️ Atrás" if lang=="es" else "⬅️ Назад"),
+                 "menu_quick": ("⬅️ Atrás" if lang=="es" else "⬅️ Назад"),
+                 "menu_forms": ("⬅️ Atrás" if lang=="es" else "⬅️ Назад")}[target]
+        kb = _STATIC_KB[("back", target, lang)] = InlineKeyboardMarkup([
+            [InlineKeyboardButton(title, callback_data=f"back_to:{target}")],
+            lang_toggle_row(lang)
+        ])
+    return kb
+
+def _build_main_kb(lang: str, logged_in: bool, verified: bool) -> InlineKeyboardMarkup:
     rows: List[List[InlineKeyboardButton]] = []
 
-    login = await get_user_login(user_id)
-    if login:
+    if logged_in:
         rows.append([InlineKeyboardButton("👤 Mi perfil" if lang=="es" else "👤 Мій профіль", callback_data="menu_profile")])
 
     if is_valid_webapp_url(WEBAPP_URL):
@@ -349,14 +548,21 @@ async def kb_main_for(user_id: int) -> InlineKeyboardMarkup:
             [InlineKeyboardButton("📝 Форми та документи", callback_data="menu_forms")],
         ]
 
-    if not await is_verified(user_id):
+    if not verified:
         rows.append([InlineKeyboardButton("🔒 Verificación" if lang=="es" else "🔒 Верифікація", callback_data="start_verify")])
 
     rows.append(lang_toggle_row(lang))
     return InlineKeyboardMarkup(rows)
 
-def kb_forms_info(lang: str) -> InlineKeyboardMarkup:
-    forms = forms_for_lang(lang)
+async def kb_main_for(user_id: int) -> InlineKeyboardMarkup:
+    st = await get_user_state(user_id)
+    variant = ("main", st["pref_lang"], bool(st["login"]), st["verified"] >= 1)
+    kb = _STATIC_KB.get(variant)
+    if kb is None:
+        kb = _STATIC_KB[variant] = _build_main_kb(*variant[1:])
+    return kb
+
+def _build_forms_kb(lang: str, forms: Dict[str, Dict[str, Any]]) -> InlineKeyboardMarkup:
     items = sorted(forms.items(), key=lambda kv: kv[1].get("name",""))
     rows = []
     for key, meta in items:
@@ -365,8 +571,8 @@ def kb_forms_info(lang: str) -> InlineKeyboardMarkup:
     rows.append(lang_toggle_row(lang))
     return InlineKeyboardMarkup(rows)
 
-def kb_form_choice(lang: str, form_key: str) -> InlineKeyboardMarkup:
-    f = forms_for_lang(lang).get(form_key) or {}
+def _build_form_choice_kb(lang: str, form_key: str, forms: Dict[str, Dict[str, Any]]) -> InlineKeyboardMarkup:
+    f = forms.get(form_key) or {}
     rows = []
     if f.get("fields"):
         rows.append([InlineKeyboardButton("✍️ Rellenar en el bot" if lang=="es" else "✍️ Заповнити в боті", callback_data=f"formfill_{form_key}")])
@@ -376,8 +582,7 @@ def kb_form_choice(lang: str, form_key: str) -> InlineKeyboardMarkup:
     rows.append(lang_toggle_row(lang))
     return InlineKeyboardMarkup(rows)
 
-def kb_quick(lang: str) -> InlineKeyboardMarkup:
-    KB = kb_for_lang(lang)
+def _build_quick_kb(lang: str, KB: Dict[str, Dict[str, Any]], tokens: Dict[str, str]) -> InlineKeyboardMarkup:
     items: List[tuple[str, str]] = []
     for k, v in KB.items():
         t = (v.get("title") or k).strip()
@@ -386,14 +591,10 @@ def kb_quick(lang: str) -> InlineKeyboardMarkup:
             items.append((k, t))
     items.sort(key=lambda it: it[1].lower())
 
-    CB_MAP[lang] = {}
-
     rows: List[List[InlineKeyboardButton]] = []
     row: List[InlineKeyboardButton] = []
     for k, t in items:
-        token = hashlib.md5(k.encode("utf-8")).hexdigest()[:10]
-        CB_MAP[lang][token] = k
-        row.append(InlineKeyboardButton(t, callback_data=f"faq_{token}"))
+        row.append(InlineKeyboardButton(t, callback_data=f"faq_{tokens[k]}"))
         if len(row) == 2:
             rows.append(row); row = []
     if row: rows.append(row)
@@ -402,9 +603,29 @@ def kb_quick(lang: str) -> InlineKeyboardMarkup:
     rows.append(lang_toggle_row(lang))
     return InlineKeyboardMarkup(rows)
 
+def kb_forms_info(lang: str, snap: Optional["ContentSnapshot"] = None) -> InlineKeyboardMarkup:
+    return (snap or CONTENT).keyboards[("forms", lang)]
+
+def kb_form_choice(lang: str, form_key: str, snap: Optional["ContentSnapshot"] = None) -> InlineKeyboardMarkup:
+    snap = snap or CONTENT
+    return snap.keyboards.get(("form_choice", lang, form_key)) or _build_form_choice_kb(lang, form_key, snap.forms[lang])
+
+def kb_quick(lang: str, snap: Optional["ContentSnapshot"] = None) -> InlineKeyboardMarkup:
+    return (snap or CONTENT).keyboards[("quick", lang)]
+
+def kb_faq_results(lang: str, keys: List[str], snap: Optional["ContentSnapshot"] = None) -> InlineKeyboardMarkup:
+    snap = snap or CONTENT
+    KB = snap.kb[lang]
+    tokens = snap.cb_tokens[lang]
+    rows = [[InlineKeyboardButton((KB[k].get("title") or k).strip(), callback_data=f"faq_{tokens[k]}")]
+            for k in keys if k in KB and k in tokens]
+    rows.append([InlineKeyboardButton("⬅️ Atrás" if lang=="es" else "⬅️ Назад", callback_data="back_to:main")])
+    rows.append(lang_toggle_row(lang))
+    return InlineKeyboardMarkup(rows)
+
 # ---------- текст для выбора способа заполнения ----------
-def _form_choice_text(lang: str, key: str) -> str:
-    forms = forms_for_lang(lang)
+def _form_choice_text(lang: str, key: str, snap: Optional["ContentSnapshot"] = None) -> str:
+    forms = forms_for_lang(lang, snap)
     f = forms.get(key)
     if not f: return "—"
     name_clean   = _clean_text(f.get("name",""))
@@ -427,8 +648,8 @@ def _form_choice_text(lang: str, key: str) -> str:
     fields_section = f"\n{fields_title}\n{fields_list}" if fields_list else ""
     return f"{title}{desc}{opt1}{opt2}{fields_section}"
 
-def _form_info_text(lang: str, key: str) -> str:
-    forms = forms_for_lang(lang)
+def _form_info_text(lang: str, key: str, snap: Optional["ContentSnapshot"] = None) -> str:
+    forms = forms_for_lang(lang, snap)
     f = forms.get(key)
     if not f: return "—"
     name_clean   = _clean_text(f.get("name",""))
@@ -447,24 +668,469 @@ async def ack(query, text: str | None = None):
     try: await query.answer(text=text, show_alert=False, cache_time=0)
     except: pass
 
-async def show_loader_and_edit(query, final_text: str, reply_markup=None, parse_mode="HTML", delay_ms=200, lang="es"):
-    try: await query.edit_message_text("⏳ <i>Cargando…</i>" if lang=="es" else "⏳ <i>Завантаження…</i>", parse_mode="HTML")
-    except: pass
-    try: await query.message.chat.send_action(ChatAction.TYPING)
-    except: pass
-    await asyncio.sleep(delay_ms/1000)
-    await query.edit_message_text(final_text, reply_markup=reply_markup, parse_mode=parse_mode, disable_web_page_preview=True)
-
-def find_best_match(user_message: str, lang: str) -> Optional[str]:
-    msg = (user_message or "").lower()
-    KB = kb_for_lang(lang)
-    for _, data in KB.items():
-        for kw in data.get("keywords", []):
-            if kw.lower() in msg:
-                return data["response"]
-    return None
+async def show_loader_and_edit(query, final_text, reply_markup=None, parse_mode="HTML", lang="es"):
+    """Одно редактирование сообщения сразу в итоговый вид. final_text / reply_markup можно
+    передать корутинами — «⏳ Cargando…» покажется, только если они считаются
+    дольше LOADER_THRESHOLD_MS."""
+    if inspect.isawaitable(final_text) or inspect.isawaitable(reply_markup):
+        async def render():
+            t = await final_text if inspect.isawaitable(final_text) else final_text
+            m = await reply_markup if inspect.isawaitable(reply_markup) else reply_markup
+            return t, m
+        job = asyncio.ensure_future(render())
+        done, _ = await asyncio.wait({job}, timeout=LOADER_THRESHOLD_MS / 1000)
+        if not done:
+            try: await query.edit_message_text("⏳ <i>Cargando…</i>" if lang=="es" else "⏳ <i>Завантаження…</i>", parse_mode="HTML")
+            except: pass
+        final_text, reply_markup = await job
+    try:
+        await query.edit_message_text(final_text, reply_markup=reply_markup, parse_mode=parse_mode, disable_web_page_preview=True)
+    except BadRequest as e:
+        # без промежуточного лоадера повторный клик по тому же экрану — это правка «в то же самое»
+        if "not modified" not in str(e).lower():
+            raise
+
+# ---------- поиск по ключевым словам (Aho–Corasick) ----------
+class KeywordMatcher:
+    """Автомат Ахо–Корасик по всем keywords одной KB: один проход по сообщению
+    независимо от размера базы. Совпадение — подстрока без учёта регистра (как раньше);
+    из нескольких побеждает самое длинное ключевое слово, затем самое раннее
+    в сообщении, затем меньший key — результат не зависит от порядка строк в таблице."""
+    __slots__ = ("goto", "fail", "out")
+
+    def __init__(self, kb: Dict[str, Dict[str, Any]]):
+        goto: List[Dict[str, int]] = [{}]
+        out: List[Optional[tuple]] = [None]   # out[state] = (len(kw), key) лучшего слова, оканчивающегося здесь
+        for key in sorted(kb):
+            for kw in kb[key].get("keywords", []):
+                kw = (kw or "").lower()
+                if not kw:
+                    continue
+                st = 0
+                for ch in kw:
+                    nxt = goto[st].get(ch)
+                    if nxt is None:
+                        nxt = len(goto)
+                        goto[st][ch] = nxt
+                        goto.append({}); out.append(None)
+                    st = nxt
+                if out[st] is None:   # ключи обходятся по возрастанию — первый и есть меньший
+                    out[st] = (len(kw), key)
+
+        fail = [0] * len(goto)
+        queue = list(goto[0].values())   # у детей корня fail = 0
+        for st in queue:
+            for ch, nxt in goto[st].items():
+                f = fail[st]
+                while f and ch not in goto[f]:
+                    f = fail[f]
+                fail[nxt] = goto[f].get(ch, 0)
+                if out[nxt] is None:
+                    out[nxt] = out[fail[nxt]]   # суффиксы всегда короче собственного слова
+                queue.append(nxt)
+        self.goto, self.fail, self.out = goto, fail, out
+
+    def best_key(self, text: str) -> Optional[str]:
+        goto, fail, out = self.goto, self.fail, self.out
+        best = None   # (-len, start, key)
+        st = 0
+        for i, ch in enumerate((text or "").lower()):
+            while st and ch not in goto[st]:
+                st = fail[st]
+            st = goto[st].get(ch, 0)
+            hit = out[st]
+            if hit is not None:
+                cand = (-hit[0], i - hit[0] + 1, hit[1])
+                if best is None or cand < best:
+                    best = cand
+        return best[2] if best else None
+
+
+# ---------- ранжированный поиск по FAQ (BM25 по токенам и основам + триграммы словаря) ----------
+_WORD_RE = re.compile(r"\w+")
+BM25_K1, BM25_B = 1.2, 0.75
+FAQ_FIELD_WEIGHTS = {"title": 3.0, "keywords": 3.0, "response": 1.0}
+FAQ_STEM_WEIGHT = 0.5      # префикс-основа: ловит словоизменение ES/UA
+FAQ_FUZZY_MIN_SIM = 0.5    # Dice по триграммам для слов с опечаткой
+FAQ_FUZZY_EXPAND = 3       # сколько ближайших слов словаря подставлять вместо незнакомого
+FAQ_FUZZY_LEN_DELTA = 2    # кандидаты ищутся только среди слов близкой длины
+FAQ_POSTINGS_CAP = 256     # на терм храним только самые «весомые» документы
+
+def _fold(s: str) -> str:
+    s = unicodedata.normalize("NFKD", (s or "").lower())
+    return "".join(ch for ch in s if not unicodedata.combining(ch))
+
+def _faq_tokens(s: str) -> List[str]:
+    return [t for t in _WORD_RE.findall(_fold(s)) if len(t) >= 2]
+
+def _stem_term(tok: str) -> Optional[str]:
+    return "~" + tok[:5] if len(tok) >= 5 else None
+
+def _trigrams(tok: str) -> set:
+    padded = f" {tok} "
+    return {padded[i:i+3] for i in range(len(padded) - 2)}
+
+def _faq_doc_terms(entry: Dict[str, Any]) -> tuple:
+    tf: Dict[str, float] = {}
+    fields = {"title": entry.get("title") or "",
+              "keywords": " ".join(entry.get("keywords") or []),
+              "response": entry.get("response") or ""}
+    dl = 0.0
+    for field, text in fields.items():
+        w = FAQ_FIELD_WEIGHTS[field]
+        for tok in _faq_tokens(text):
+            tf[tok] = tf.get(tok, 0.0) + w
+            stem = _stem_term(tok)
+            if stem: tf[stem] = tf.get(stem, 0.0) + w
+            dl += w
+    return tf, dl
+
+def _faq_entry_hash(entry: Dict[str, Any]) -> str:
+    raw = "\x1f".join([entry.get("title") or "", "\x1e".join(entry.get("keywords") or []), entry.get("response") or ""])
+    return hashlib.blake2b(raw.encode("utf-8"), digest_size=12).hexdigest()
+
+class FaqIndex:
+    """Инвертированный индекс FAQ одного языка. Разбор текста кэшируется по хэшу
+    записи, так что при перезагрузке таблицы заново анализируются только изменённые
+    строки. Вклад BM25 каждого постинга считается при сборке, и запрос — это сумма
+    по нескольким коротким спискам. Слова с опечатками сопоставляются со словарём
+    индекса по триграммам, без перебора документов."""
+    __slots__ = ("docs", "postings", "tri_vocab", "_fuzzy_cache")
+
+    def __init__(self, kb: Dict[str, Dict[str, Any]], prev: Optional["FaqIndex"] = None):
+        docs: Dict[str, tuple] = {}
+        for key, entry in kb.items():
+            h = _faq_entry_hash(entry)
+            old = prev.docs.get(key) if prev else None
+            docs[key] = old if old and old[0] == h else (h, *_faq_doc_terms(entry))
+        self.docs = docs
+
+        n = len(docs)
+        avgdl = (sum(d[2] for d in docs.values()) / n) if n else 1.0
+        df: Dict[str, int] = {}
+        for _, tf, _ in docs.values():
+            for t in tf:
+                df[t] = df.get(t, 0) + 1
+        idf = {t: math.log(1 + (n - c + 0.5) / (c + 0.5)) for t, c in df.items()}
+        postings: Dict[str, List[tuple]] = {}
+        for key, (_, tf, dl) in docs.items():
+            norm = BM25_K1 * (1 - BM25_B + BM25_B * (dl / avgdl if avgdl else 1.0))
+            for t, f in tf.items():
+                w = idf[t] * f * (BM25_K1 + 1) / (f + norm)
+                if t[0] == "~": w *= FAQ_STEM_WEIGHT
+                postings.setdefault(t, []).append((key, w))
+        for lst in postings.values():
+            if len(lst) > FAQ_POSTINGS_CAP:
+                lst.sort(key=lambda kw: -kw[1])
+                del lst[FAQ_POSTINGS_CAP:]
+        self.postings = postings
+
+        tri_vocab: Dict[tuple, List[str]] = {}   # (триграмма, длина слова) -> слова словаря
+        for t in postings:
+            if t[0] != "~":
+                for tri in _trigrams(t):
+                    tri_vocab.setdefault((tri, len(t)), []).append(t)
+        self.tri_vocab = tri_vocab
+        self._fuzzy_cache: Dict[str, List[tuple]] = {}
+
+    def _fuzzy(self, tok: str) -> List[tuple]:
+        hit = self._fuzzy_cache.get(tok)
+        if hit is not None:
+            return hit
+        grams = _trigrams(tok)
+        lens = range(max(2, len(tok) - FAQ_FUZZY_LEN_DELTA), len(tok) + FAQ_FUZZY_LEN_DELTA + 1)
+        lists = sorted(([w for n in lens for w in self.tri_vocab.get((tri, n), ())] for tri in grams), key=len)
+        # Dice ≥ FAQ_FUZZY_MIN_SIM требует минимум need общих триграмм, значит кандидат
+        # обязательно встретится в одном из (|grams| - need + 1) самых редких списков
+        need = max(1, math.ceil(FAQ_FUZZY_MIN_SIM * (2 * len(grams) - FAQ_FUZZY_LEN_DELTA) / 2))
+        seen = {w for lst in lists[:max(1, len(grams) - need + 1)] for w in lst}
+        cands = []
+        for t in seen:
+            sim = 2 * len(grams & _trigrams(t)) / (len(grams) + len(t))   # Dice; у слова из n букв n триграмм
+            if sim >= FAQ_FUZZY_MIN_SIM:
+                cands.append((t, sim))
+        best = heapq.nsmallest(FAQ_FUZZY_EXPAND, cands, key=lambda ts: (-ts[1], ts[0]))
+        if len(self._fuzzy_cache) < 4096:
+            self._fuzzy_cache[tok] = best
+        return best
+
+    def _query_terms(self, text: str) -> Dict[str, float]:
+        terms: Dict[str, float] = {}
+        for tok in _faq_tokens(text):
+            stem = _stem_term(tok)
+            if tok in self.postings:
+                terms[tok] = 1.0
+                if stem: terms[stem] = 1.0
+            elif stem and stem in self.postings:
+                terms[stem] = 1.0
+            else:
+                for t, sim in self._fuzzy(tok):
+                    terms[t] = max(terms.get(t, 0.0), sim)
+        return terms
+
+    def search(self, text: str, k: int = FAQ_TOP_K) -> List[tuple]:
+        scores: Dict[str, float] = {}
+        for t, mult in self._query_terms(text).items():
+            for key, w in self.postings.get(t, ()):
+                scores[key] = scores.get(key, 0.0) + w * mult
+        return heapq.nsmallest(k, ((key, sc) for key, sc in scores.items() if sc >= FAQ_MIN_SCORE),
+                               key=lambda kv: (-kv[1], kv[0]))
+
+# ---------- снимок контента ----------
+class ContentSnapshot:
+    """Неизменяемый снимок контента из таблицы: KB и формы по языкам плюс всё, что из
+    них выводится (автомат ключевых слов, индекс FAQ, клавиатуры, callback-токены).
+    Перезагрузка собирает новый снимок целиком и подменяет CONTENT одним
+    присваиванием; хендлер, начавший работу со старым снимком, дорабатывает с ним.
+    Производные кэши могут ключеваться по version."""
+    __slots__ = ("version", "kb", "forms", "matchers", "faq_indexes", "cb_map", "cb_tokens", "keyboards")
+
+    def __init__(self, version: int, kb: Dict[str, Dict[str, Dict[str, Any]]], forms: Dict[str, Dict[str, Dict[str, Any]]],
+                 prev: Optional["ContentSnapshot"] = None):
+        self.version = version
+        self.kb = kb
+        self.forms = forms
+        self.matchers = {lang: KeywordMatcher(kb[lang]) for lang in LANGS}
+        self.faq_indexes: Dict[str, FaqIndex] = {}
+        if FAQ_SEARCH_MODE == "ranked":
+            self.faq_indexes = {lang: FaqIndex(kb[lang], prev.faq_indexes.get(lang) if prev else None) for lang in LANGS}
+        self.cb_tokens = {lang: {k: _cb_token(k) for k in kb[lang]} for lang in LANGS}
+        self.cb_map = {lang: {t: k for k, t in self.cb_tokens[lang].items()} for lang in LANGS}
+        keyboards: Dict[tuple, InlineKeyboardMarkup] = {}
+        for lang in LANGS:
+            keyboards[("quick", lang)] = _build_quick_kb(lang, kb[lang], self.cb_tokens[lang])
+            keyboards[("forms", lang)] = _build_forms_kb(lang, forms[lang])
+            for key in forms[lang]:
+                keyboards[("form_choice", lang, key)] = _build_form_choice_kb(lang, key, forms[lang])
+        self.keyboards = keyboards
+
+CONTENT = ContentSnapshot(0, {lang: {} for lang in LANGS}, {lang: {} for lang in LANGS})
+
+def search_faq(text: str, lang: str, k: int = FAQ_TOP_K, snap: Optional[ContentSnapshot] = None) -> List[tuple]:
+    idx = (snap or CONTENT).faq_indexes.get(lang)
+    return idx.search(text, k) if idx else []
+
+def find_best_match(user_message: str, lang: str, snap: Optional[ContentSnapshot] = None) -> Optional[str]:
+    snap = snap or CONTENT
+    m = snap.matchers.get(lang)
+    key = m.best_key(user_message) if m else None
+    if not key:
+        return None
+    data = snap.kb[lang].get(key)
+    return data["response"] if data else None
+
+# ---------- метрики (Prometheus text format, отдаются на служебном HTTP как /metrics) ----------
+# Счётчики и гистограммы — в памяти процесса; prometheus_client не нужен: типов метрик три,
+# формат вывода один. Значения меток — только из ограниченных наборов (хендлер, маршрут,
+# операция, вкладка), никогда не из пользовательского ввода.
+_METRICS: List["_Metric"] = []
+_METRIC_COLLECTORS: List[Callable[[], Any]] = []   # корутины, обновляющие датчики перед выдачей
+_LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+def _metric_labels(names: tuple, values: tuple, *extra: tuple) -> str:
+    pairs = [*zip(names, values), *extra]
+    if not pairs:
+        return ""
+    esc = lambda v: str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+    return "{" + ",".join(f'{k}="{esc(v)}"' for k, v in pairs) + "}"
+
+class _Metric:
+    kind = "untyped"
+
+    def __init__(self, name: str, doc: str, labels: tuple = ()):
+        self.name, self.doc, self.labels = name, doc, labels
+        self.values: Dict[tuple, Any] = {}
+        _METRICS.append(self)
+
+    def _samples(self) -> Iterator[str]:
+        for lv, v in sorted(self.values.items()):
+            yield f"{self.name}{_metric_labels(self.labels, lv)} {v}"
+
+    def render(self) -> Iterator[str]:
+        yield f"# HELP {self.name} {self.doc}"
+        yield f"# TYPE {self.name} {self.kind}"
+        yield from self._samples()
+
+class _Counter(_Metric):
+    kind = "counter"
+
+    def inc(self, *lv, n: float = 1):
+        self.values[lv] = self.values.get(lv, 0) + n
+
+class _Gauge(_Metric):
+    kind = "gauge"
+
+    def set(self, value: float, *lv):
+        self.values[lv] = value
+
+class _Histogram(_Metric):
+    kind = "histogram"
+
+    def __init__(self, name: str, doc: str, labels: tuple = (), buckets: tuple = _LATENCY_BUCKETS):
+        super().__init__(name, doc, labels)
+        self.buckets = buckets
+
+    def observe(self, value: float, *lv):
+        st = self.values.get(lv)
+        if st is None:
+            st = self.values[lv] = [[0] * (len(self.buckets) + 1), 0.0]   # счётчики по корзинам (+Inf последней), сумма
+        st[0][bisect.bisect_left(self.buckets, value)] += 1
+        st[1] += value
+
+    @contextlib.contextmanager
+    def timer(self, *lv):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - t0, *lv)
+
+    def _samples(self) -> Iterator[str]:
+        for lv, (counts, total) in sorted(self.values.items()):
+            acc = 0
+            for le, c in zip((*map(str, self.buckets), "+Inf"), counts):
+                acc += c
+                yield f"{self.name}_bucket{_metric_labels(self.labels, lv, ('le', le))} {acc}"
+            yield f"{self.name}_sum{_metric_labels(self.labels, lv)} {total:.6f}"
+            yield f"{self.name}_count{_metric_labels(self.labels, lv)} {acc}"
+
+async def render_metrics() -> str:
+    for collect in _METRIC_COLLECTORS:
+        try:
+            await collect()
+        except Exception as e:
+            log.debug(f"[metrics] collector {collect.__name__}: {e}")
+    return "\n".join(line for m in _METRICS for line in m.render()) + "\n"
+
+HANDLER_SECONDS     = _Histogram("hrbot_handler_seconds", "Update handling latency by handler and route", ("handler", "route"))
+DB_QUERY_SECONDS    = _Histogram("hrbot_db_query_seconds", "DB call latency; _count is the number of calls", ("op",))
+DB_ERRORS           = _Counter("hrbot_db_errors_total", "Failed DB calls", ("op",))
+SHEET_FETCH_SECONDS = _Histogram("hrbot_sheet_fetch_seconds", "Sheet tab download time, retries included", ("tab",))
+SHEET_FETCHES       = _Counter("hrbot_sheet_fetches_total", "Sheet tab fetches by outcome", ("tab", "result"))
+SHEET_PARSE_SECONDS = _Histogram("hrbot_sheet_parse_seconds", "Sheet tab parse and profile staging time", ("tab",))
+SHEET_ROWS          = _Gauge("hrbot_sheet_rows", "Rows in the last parsed version of a sheet tab", ("tab",))
+SHEET_SYNC_SECONDS  = _Histogram("hrbot_sheet_sync_seconds", "Full sheet sync time by outcome", ("result",))
+SMTP_SEND_SECONDS   = _Histogram("hrbot_smtp_send_seconds", "SMTP send latency, reconnects included", ("result",))
+SMTP_FAILURES       = _Counter("hrbot_smtp_failures_total", "Failed SMTP sends: retry = will be retried, failed = given up", ("kind",))
+UPDATE_QUEUE_DEPTH  = _Gauge("hrbot_update_queue_depth", "Updates received but not yet taken by the application")
+UPDATES_WAITING     = _Gauge("hrbot_updates_waiting", "Updates waiting for a per-user lock or a concurrency slot")
+UPDATES_IN_FLIGHT   = _Gauge("hrbot_updates_in_flight", "Updates being handled right now")
+
+# Метка апдейта [handler, route]: процессор апдейтов кладёт её в контекст по типу апдейта
+# (префикс callback, имя команды), хендлер уточняет через metrics_route() — например, ветку free_text.
+_METRIC_ROUTE: contextvars.ContextVar = contextvars.ContextVar("metric_route", default=None)
+
+def metrics_route(handler: str, route: str = ""):
+    label = _METRIC_ROUTE.get()
+    if label is not None:
+        label[:] = handler, route
+
+def db_timed(op: str):
+    def deco(fn):
+        @functools.wraps(fn)
+        async def wrapper(*args, **kwargs):
+            t0 = time.perf_counter()
+            try:
+                return await fn(*args, **kwargs)
+            except Exception:
+                DB_ERRORS.inc(op)
+                raise
+            finally:
+                DB_QUERY_SECONDS.observe(time.perf_counter() - t0, op)
+        return wrapper
+    return deco
 
 # ---------- БД ----------
+# Один долгоживущий коннект на процесс вместо aiosqlite.connect() (= новый поток)
+# в каждом хелпере. sqlite3 кэширует подготовленные выражения на соединении,
+# поэтому повторяющиеся запросы хендлеров не компилируются заново.
+# База в WAL: db_fetchone / db_fetchall идут через второе, читающее соединение
+# (свой поток aiosqlite) и не ждут пишущих транзакций db_tx.
+DB_CACHED_STATEMENTS = int(os.getenv("DB_CACHED_STATEMENTS") or "256")
+DB_CACHE_KB = int(os.getenv("DB_CACHE_KB") or "16384")   # page cache на соединение
+
+_DB: Optional[aiosqlite.Connection] = None
+_DB_READ: Optional[aiosqlite.Connection] = None
+_DB_OPEN_LOCK = asyncio.Lock()
+_DB_WRITE_LOCK = asyncio.Lock()  # транзакции записи на общем соединении не должны перемежаться
+
+async def _open_db(read_only: bool) -> aiosqlite.Connection:
+    db = await aiosqlite.connect(DB_PATH.as_posix(), cached_statements=DB_CACHED_STATEMENTS)
+    if not read_only:
+        await db.execute("PRAGMA journal_mode=WAL")   # хранится в файле базы; с ним читатели не блокируются писателем
+    await db.execute("PRAGMA synchronous=NORMAL")     # в WAL fsync только на чекпойнте; коммит переживает падение процесса
+    await db.execute(f"PRAGMA cache_size=-{DB_CACHE_KB}")
+    await db.execute("PRAGMA temp_store=MEMORY")
+    await db.execute("PRAGMA busy_timeout=5000")
+    if read_only:
+        await db.execute("PRAGMA query_only=ON")
+    return db
+
+async def get_db() -> aiosqlite.Connection:
+    global _DB
+    if _DB is None:
+        async with _DB_OPEN_LOCK:
+            if _DB is None:
+                _DB = await _open_db(read_only=False)
+    return _DB
+
+async def get_read_db() -> aiosqlite.Connection:
+    global _DB_READ
+    if _DB_READ is None:
+        await get_db()   # писатель первым: он включает WAL
+        async with _DB_OPEN_LOCK:
+            if _DB_READ is None:
+                _DB_READ = await _open_db(read_only=True)
+    return _DB_READ
+
+async def close_db():
+    global _DB, _DB_READ, _DB_READY
+    _DB_READY = False
+    for db in (_DB_READ, _DB):
+        if db is not None:
+            await db.close()
+    _DB = _DB_READ = None
+
+@contextlib.asynccontextmanager
+async def db_tx():
+    """Транзакция записи на общем соединении: commit при выходе, rollback при ошибке."""
+    db = await get_db()
+    t0 = time.perf_counter()
+    async with _DB_WRITE_LOCK:
+        t1 = time.perf_counter()
+        DB_QUERY_SECONDS.observe(t1 - t0, "tx_lock_wait")
+        try:
+            yield db
+        except BaseException:
+            await db.rollback()
+            DB_ERRORS.inc("tx")
+            raise
+        await db.commit()
+        DB_QUERY_SECONDS.observe(time.perf_counter() - t1, "tx")
+
+@db_timed("fetchone")
+async def db_fetchone(sql: str, params: tuple = ()):
+    db = await get_read_db()
+    async with db.execute(sql, params) as cur:
+        return await cur.fetchone()
+
+@db_timed("fetchall")
+async def db_fetchall(sql: str, params: tuple = ()):
+    db = await get_read_db()
+    async with db.execute(sql, params) as cur:
+        return await cur.fetchall()
+
+def _sql_statements(script: str) -> List[str]:
+    # executescript() сам делает COMMIT посреди db_tx — режем скрипт на выражения (с учётом BEGIN…END триггеров)
+    out, buf = [], ""
+    for line in script.splitlines(keepends=True):
+        buf += line
+        if sqlite3.complete_statement(buf):
+            out.append(buf.strip()); buf = ""
+    if buf.strip():
+        out.append(buf.strip())
+    return out
+
 CREATE_FORMS_SQL = """
 CREATE TABLE IF NOT EXISTS form_submissions (
     id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -475,6 +1141,117 @@ CREATE TABLE IF NOT EXISTS form_submissions (
     created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
 );
 """
+CREATE_OUTBOX_SQL = """
+CREATE TABLE IF NOT EXISTS email_outbox (
+    id INTEGER PRIMARY KEY AUTOINCREMENT,
+    to_email TEXT NOT NULL,
+    subject TEXT,
+    body TEXT,
+    tg_user_id INTEGER,
+    lang TEXT,
+    status TEXT NOT NULL DEFAULT 'pending',   -- pending | sending | sent | failed | expired
+    attempts INTEGER NOT NULL DEFAULT 0,
+    next_try_at REAL NOT NULL,
+    expires_at REAL,
+    last_error TEXT,
+    created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+    done_at TIMESTAMP
+);
+"""
+# Агрегаты для /stats поддерживаются триггерами на users — /stats ничего не сканирует.
+#   stats_totals       — одна строка: пользователи, сообщения, клики
+#   users_by_last_day  — сколько пользователей последний раз были активны в этот день (UTC);
+#                        активные за N дней = сумма ≤ N строк
+#   daily_stats        — дневной срез: активные, новые, сообщения, клики
+# Первый визит пользователя за день — это ровно смена date(last_seen), отсюда active_users.
+CREATE_STATS_SQL = """
+CREATE TABLE IF NOT EXISTS stats_totals (
+    id INTEGER PRIMARY KEY CHECK (id = 1),
+    users INTEGER NOT NULL DEFAULT 0,
+    msgs INTEGER NOT NULL DEFAULT 0,
+    clicks INTEGER NOT NULL DEFAULT 0
+);
+CREATE TABLE IF NOT EXISTS users_by_last_day (
+    day TEXT PRIMARY KEY,
+    n INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS daily_stats (
+    day TEXT PRIMARY KEY,
+    active_users INTEGER NOT NULL DEFAULT 0,
+    new_users INTEGER NOT NULL DEFAULT 0,
+    msgs INTEGER NOT NULL DEFAULT 0,
+    clicks INTEGER NOT NULL DEFAULT 0
+);
+CREATE TRIGGER IF NOT EXISTS trg_users_stats_ins AFTER INSERT ON users BEGIN
+    UPDATE stats_totals SET users = users + 1, msgs = msgs + NEW.msg_count, clicks = clicks + NEW.click_count WHERE id = 1;
+    INSERT INTO users_by_last_day (day, n) VALUES (date(NEW.last_seen), 1)
+        ON CONFLICT(day) DO UPDATE SET n = n + 1;
+    INSERT INTO daily_stats (day, active_users, new_users, msgs, clicks)
+        VALUES (date(NEW.last_seen), 1, 1, NEW.msg_count, NEW.click_count)
+        ON CONFLICT(day) DO UPDATE SET active_users = active_users + 1, new_users = new_users + 1,
+                                       msgs = msgs + excluded.msgs, clicks = clicks + excluded.clicks;
+END;
+CREATE TRIGGER IF NOT EXISTS trg_users_stats_upd AFTER UPDATE OF last_seen, msg_count, click_count ON users BEGIN
+    UPDATE stats_totals SET msgs = msgs + NEW.msg_count - OLD.msg_count,
+                            clicks = clicks + NEW.click_count - OLD.click_count WHERE id = 1;
+    UPDATE users_by_last_day SET n = n - 1 WHERE day = date(OLD.last_seen) AND date(NEW.last_seen) <> date(OLD.last_seen);
+    DELETE FROM users_by_last_day WHERE day = date(OLD.last_seen) AND n <= 0;
+    INSERT INTO users_by_last_day (day, n) SELECT date(NEW.last_seen), 1 WHERE date(NEW.last_seen) <> date(OLD.last_seen)
+        ON CONFLICT(day) DO UPDATE SET n = n + 1;
+    INSERT INTO daily_stats (day, active_users, msgs, clicks)
+        VALUES (date(NEW.last_seen), date(NEW.last_seen) <> date(OLD.last_seen),
+                NEW.msg_count - OLD.msg_count, NEW.click_count - OLD.click_count)
+        ON CONFLICT(day) DO UPDATE SET active_users = active_users + excluded.active_users,
+                                       msgs = msgs + excluded.msgs, clicks = clicks + excluded.clicks;
+END;
+CREATE TRIGGER IF NOT EXISTS trg_users_stats_del AFTER DELETE ON users BEGIN
+    UPDATE stats_totals SET users = users - 1, msgs = msgs - OLD.msg_count, clicks = clicks - OLD.click_count WHERE id = 1;
+    UPDATE users_by_last_day SET n = n - 1 WHERE day = date(OLD.last_seen);
+    DELETE FROM users_by_last_day WHERE day = date(OLD.last_seen) AND n <= 0;
+END;
+"""
+# первый запуск на существующей базе: итоги и «последний день» точные,
+# дневной срез восстанавливается приближённо (новые — по first_seen, активные — по last_seen)
+BACKFILL_STATS_SQL = """
+INSERT INTO stats_totals (id, users, msgs, clicks)
+    SELECT 1, COUNT(*), IFNULL(SUM(msg_count),0), IFNULL(SUM(click_count),0) FROM users;
+INSERT INTO users_by_last_day (day, n)
+    SELECT date(last_seen), COUNT(*) FROM users GROUP BY date(last_seen);
+INSERT OR IGNORE INTO daily_stats (day) SELECT DISTINCT date(first_seen) FROM users;
+INSERT OR IGNORE INTO daily_stats (day) SELECT DISTINCT date(last_seen) FROM users;
+UPDATE daily_stats SET
+    new_users    = (SELECT COUNT(*) FROM users WHERE date(first_seen) = daily_stats.day),
+    active_users = (SELECT COUNT(*) FROM users WHERE date(last_seen) = daily_stats.day);
+"""
+CREATE_PROFILES_SQL = """
+CREATE TABLE IF NOT EXISTS profiles (
+    login TEXT PRIMARY KEY,
+    full_name TEXT,
+    position TEXT,
+    team TEXT,
+    email TEXT,
+    phone TEXT,
+    manager TEXT,
+    vacation_left INTEGER,
+    salary_usd INTEGER,
+    extra_json TEXT,
+    row_hash TEXT,
+    src_tab TEXT
+);
+"""
+CREATE_PERSIST_SQL = """
+CREATE TABLE IF NOT EXISTS bot_user_data (
+    user_id INTEGER PRIMARY KEY,
+    data_json TEXT NOT NULL,
+    updated_at TEXT DEFAULT CURRENT_TIMESTAMP
+);
+CREATE TABLE IF NOT EXISTS bot_conversations (
+    name TEXT NOT NULL,
+    conv_key TEXT NOT NULL,
+    state TEXT NOT NULL,
+    PRIMARY KEY (name, conv_key)
+);
+"""
 CREATE_USERS_SQL = """
 CREATE TABLE IF NOT EXISTS users (
     id INTEGER PRIMARY KEY,
@@ -492,94 +1269,259 @@ CREATE TABLE IF NOT EXISTS users (
     click_count INTEGER DEFAULT 0
 );
 """
-async def init_db():
-    async with aiosqlite.connect(DB_PATH.as_posix()) as db:
-        await db.execute(CREATE_FORMS_SQL)
-        await db.execute(CREATE_USERS_SQL)
-        await db.execute("""
-        CREATE TABLE IF NOT EXISTS profiles (
-            login TEXT PRIMARY KEY,
-            full_name TEXT,
-            position TEXT,
-            team TEXT,
-            email TEXT,
-            phone TEXT,
-            manager TEXT,
-            vacation_left INTEGER,
-            salary_usd INTEGER,
-            extra_json TEXT
+# ---------- миграции схемы ----------
+# Версия схемы — PRAGMA user_version. Каждый шаг применяется один раз, в своей транзакции
+# вместе с новой версией; на уже мигрированной базе старт — одно чтение user_version.
+async def _migrate_baseline(db):
+    # база, созданная до миграций, могла пропустить любые колонки — догоняем их здесь один раз
+    await db.execute(CREATE_FORMS_SQL)
+    await db.execute(CREATE_USERS_SQL)
+    await db.execute(CREATE_PROFILES_SQL)
+    cur = await db.execute("PRAGMA table_info(profiles)")
+    pcols = {row[1] for row in await cur.fetchall()}
+    if "row_hash" not in pcols: await db.execute("ALTER TABLE profiles ADD COLUMN row_hash TEXT")
+    if "src_tab" not in pcols:  await db.execute("ALTER TABLE profiles ADD COLUMN src_tab TEXT")
+    cur = await db.execute("PRAGMA table_info(users)")
+    cols = {row[1] for row in await cur.fetchall()}
+    if "pref_lang" not in cols:   await db.execute("ALTER TABLE users ADD COLUMN pref_lang TEXT DEFAULT 'es'")
+    if "login" not in cols:       await db.execute("ALTER TABLE users ADD COLUMN login TEXT")
+    if "verified" not in cols:    await db.execute("ALTER TABLE users ADD COLUMN verified INTEGER DEFAULT 0")
+    if "msg_count" not in cols:   await db.execute("ALTER TABLE users ADD COLUMN msg_count INTEGER DEFAULT 0")
+    if "click_count" not in cols: await db.execute("ALTER TABLE users ADD COLUMN click_count INTEGER DEFAULT 0")
+    if "updated_at" not in cols:  await db.execute("ALTER TABLE users ADD COLUMN updated_at TIMESTAMP")  # смена pref_lang / login / verified
+    await db.execute("UPDATE users SET pref_lang = COALESCE(pref_lang,'es')")
+
+async def _migrate_stats(db):
+    for stmt in _sql_statements(CREATE_STATS_SQL):
+        await db.execute(stmt)
+    cur = await db.execute("SELECT 1 FROM stats_totals WHERE id = 1")
+    if not await cur.fetchone():
+        for stmt in _sql_statements(BACKFILL_STATS_SQL):
+            await db.execute(stmt)
+
+MIGRATIONS = [
+    (1, "baseline tables", _migrate_baseline),
+    (2, "email outbox, bot persistence", CREATE_OUTBOX_SQL + CREATE_PERSIST_SQL),
+    (3, "materialized stats", _migrate_stats),
+    (4, "hot-path indexes", """
+        CREATE INDEX IF NOT EXISTS idx_users_login ON users(login);
+        CREATE INDEX IF NOT EXISTS idx_users_last_seen ON users(last_seen, id);
+        CREATE INDEX IF NOT EXISTS idx_forms_user_key_created ON form_submissions(tg_user_id, form_key, created_at);
+        CREATE INDEX IF NOT EXISTS idx_profiles_src_tab ON profiles(src_tab);
+        CREATE INDEX IF NOT EXISTS idx_outbox_due ON email_outbox(status, next_try_at);
+    """),
+    (5, "form export index", """
+        CREATE INDEX IF NOT EXISTS idx_forms_key_created ON form_submissions(form_key, created_at);
+    """),
+    # сколько профилей было во вкладке после последнего применённого синка — база для защиты от
+    # обрезанного экспорта в merge_profiles
+    (6, "profile tab baselines", """
+        CREATE TABLE IF NOT EXISTS profile_tabs (
+            tab TEXT PRIMARY KEY,
+            profiles INTEGER NOT NULL
         );
-        """)
-        cur = await db.execute("PRAGMA table_info(users)")
-        cols = {row[1] for row in await cur.fetchall()}
-        if "pref_lang" not in cols:   await db.execute("ALTER TABLE users ADD COLUMN pref_lang TEXT DEFAULT 'es'")
-        if "login" not in cols:       await db.execute("ALTER TABLE users ADD COLUMN login TEXT")
-        if "verified" not in cols:    await db.execute("ALTER TABLE users ADD COLUMN verified INTEGER DEFAULT 0")
-        if "msg_count" not in cols:   await db.execute("ALTER TABLE users ADD COLUMN msg_count INTEGER DEFAULT 0")
-        if "click_count" not in cols: await db.execute("ALTER TABLE users ADD COLUMN click_count INTEGER DEFAULT 0")
-        await db.execute("UPDATE users SET pref_lang = COALESCE(pref_lang,'es')")
-        await db.commit()
+    """),
+    # страница /users читается целиком из индекса, без перехода в таблицу на каждую строку
+    (7, "covering users page index", """
+        DROP INDEX IF EXISTS idx_users_last_seen;
+        CREATE INDEX idx_users_last_seen ON users(last_seen, id, username, first_name, last_name,
+                                                  language_code, msg_count, click_count, login);
+    """),
+]
+
+_DB_READY = False
+_DB_INIT_LOCK = asyncio.Lock()
+
+async def init_db():
+    global _DB_READY
+    if _DB_READY:
+        return
+    async with _DB_INIT_LOCK:
+        if _DB_READY:
+            return
+        db = await get_db()
+        cur = await db.execute("PRAGMA user_version")
+        (current,) = await cur.fetchone()
+        for version, title, step in MIGRATIONS:
+            if version <= current:
+                continue
+            async with db_tx() as tx:
+                # sqlite3 сам открывает транзакцию только перед DML, а DDL без неё коммитится
+                # сразу — явный BEGIN делает шаг и новую user_version атомарными
+                await tx.execute("BEGIN")
+                if callable(step):
+                    await step(tx)
+                else:
+                    for stmt in _sql_statements(step):
+                        await tx.execute(stmt)
+                await tx.execute(f"PRAGMA user_version = {version}")
+            log.info(f"[db] migrated to v{version}: {title}")
+        await db.execute("PRAGMA optimize")
+        _DB_READY = True
 
 def is_admin(uid: int) -> bool: return uid in ADMIN_IDS
 
+# ---------- кэш состояния пользователя (pref_lang / login / verified) ----------
+# Одно чтение users на апдейт (и ноль для «тёплого» пользователя); сеттеры ниже
+# пишут в БД и сразу обновляют запись кэша (write-through).
+USER_CACHE_MAX     = int(os.getenv("USER_CACHE_MAX") or "10000")
+USER_CACHE_TTL_SEC = int(os.getenv("USER_CACHE_TTL_SEC") or "300")
+
+_USER_CACHE: "OrderedDict[int, dict]" = OrderedDict()
+
+async def get_user_state(user_id: int) -> dict:
+    st = _USER_CACHE.get(user_id)
+    now = time.monotonic()
+    if st is not None and now - st["ts"] < USER_CACHE_TTL_SEC:
+        _USER_CACHE.move_to_end(user_id)
+        return st
+    row = await db_fetchone("SELECT pref_lang, login, verified FROM users WHERE id=?", (user_id,))
+    st = {
+        "pref_lang": row[0] if row and row[0] in LANGS else "es",
+        "login": row[1] if row and row[1] else None,
+        "verified": int(row[2]) if row and row[2] is not None else 0,
+        "exists": row is not None,
+        "ts": now,
+    }
+    _USER_CACHE[user_id] = st
+    _USER_CACHE.move_to_end(user_id)
+    while len(_USER_CACHE) > USER_CACHE_MAX:
+        _USER_CACHE.popitem(last=False)
+    return st
+
+def _user_cache_set(user_id: int, **fields):
+    st = _USER_CACHE.get(user_id)
+    if st is not None:
+        st.update(fields)
+
+def user_cache_invalidate(user_id: Optional[int] = None):
+    if user_id is None: _USER_CACHE.clear()
+    else: _USER_CACHE.pop(user_id, None)
+
 async def get_pref_lang(user_id: int) -> str:
-    async with aiosqlite.connect(DB_PATH.as_posix()) as db:
-        cur = await db.execute("SELECT pref_lang FROM users WHERE id=?", (user_id,))
-        row = await cur.fetchone()
-    return row[0] if row and row[0] in LANGS else "es"
+    return (await get_user_state(user_id))["pref_lang"]
 
 async def set_pref_lang(user_id: int, lang: str):
     if lang not in LANGS: return
-    async with aiosqlite.connect(DB_PATH.as_posix()) as db:
-        await db.execute("UPDATE users SET pref_lang=? WHERE id=?", (lang, user_id))
-        await db.commit()
+    async with db_tx() as db:
+        await db.execute("UPDATE users SET pref_lang=?, updated_at=CURRENT_TIMESTAMP WHERE id=?", (lang, user_id))
+    _user_cache_set(user_id, pref_lang=lang)
+
+# ---------- активность: write-behind счётчики ----------
+# msg_count / click_count / last_seen копятся в памяти и пишутся одной транзакцией
+# раз в TRACK_FLUSH_SEC или при TRACK_FLUSH_MAX пользователях в буфере.
+# При падении процесса теряется не больше одного интервала счётчиков.
+TRACK_FLUSH_SEC = float(os.getenv("TRACK_FLUSH_SEC") or "1.0")
+TRACK_FLUSH_MAX = int(os.getenv("TRACK_FLUSH_MAX") or "500")
+
+_TRACK_SQL = """
+    INSERT INTO users (id, username, first_name, last_name, language_code, is_bot, last_seen, msg_count, click_count)
+    VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+    ON CONFLICT(id) DO UPDATE SET
+      username=excluded.username,
+      first_name=excluded.first_name,
+      last_name=excluded.last_name,
+      language_code=excluded.language_code,
+      is_bot=excluded.is_bot,
+      last_seen=excluded.last_seen,
+      msg_count = users.msg_count + excluded.msg_count,
+      click_count = users.click_count + excluded.click_count;
+"""
+
+_ACTIVITY: Dict[int, dict] = {}
+_ACTIVITY_KICK = asyncio.Event()
+_ACTIVITY_TASK: Optional[asyncio.Task] = None
+
+def _utc_now_str() -> str:
+    # тот же формат, что у CURRENT_TIMESTAMP в SQLite
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
+
+def _activity_params(uid: int, a: dict) -> tuple:
+    return (uid, a["username"], a["first_name"], a["last_name"], a["language_code"],
+            a["is_bot"], a["ts"], a["msg"], a["click"])
 
 async def track_user(update: Update, *, inc_msg=0, inc_click=0):
     u = update.effective_user
     if not u: return
-    async with aiosqlite.connect(DB_PATH.as_posix()) as db:
-        await db.execute("""
-            INSERT INTO users (id, username, first_name, last_name, language_code, pref_lang, is_bot, msg_count, click_count)
-            VALUES (?, ?, ?, ?, ?, COALESCE((SELECT pref_lang FROM users WHERE id=?),'es'), ?, ?, ?)
-            ON CONFLICT(id) DO UPDATE SET
-              username=excluded.username,
-              first_name=excluded.first_name,
-              last_name=excluded.last_name,
-              language_code=excluded.language_code,
-              is_bot=excluded.is_bot,
-              last_seen=CURRENT_TIMESTAMP,
-              msg_count = users.msg_count + ?,
-              click_count = users.click_count + ?;
-        """, (
-            u.id, u.username or "", u.first_name or "", u.last_name or "",
-            getattr(u, "language_code", None) or "",
-            u.id, int(u.is_bot), inc_msg, inc_click, inc_msg, inc_click
-        ))
-        await db.commit()
+    a = _ACTIVITY.get(u.id)
+    if a is None:
+        a = {"msg": 0, "click": 0}
+        st = await get_user_state(u.id)
+        if not st["exists"]:
+            # первый контакт пишем сразу: следующие сеттеры делают UPDATE по этой строке
+            a = {"msg": inc_msg, "click": inc_click}
+            a.update(username=u.username or "", first_name=u.first_name or "", last_name=u.last_name or "",
+                     language_code=getattr(u, "language_code", None) or "", is_bot=int(u.is_bot), ts=_utc_now_str())
+            async with db_tx() as db:
+                await db.execute(_TRACK_SQL, _activity_params(u.id, a))
+            st["exists"] = True
+            return
+        _ACTIVITY[u.id] = a
+    a.update(username=u.username or "", first_name=u.first_name or "", last_name=u.last_name or "",
+             language_code=getattr(u, "language_code", None) or "", is_bot=int(u.is_bot), ts=_utc_now_str())
+    a["msg"] += inc_msg
+    a["click"] += inc_click
+    if len(_ACTIVITY) >= TRACK_FLUSH_MAX:
+        _ACTIVITY_KICK.set()
+
+async def flush_activity():
+    global _ACTIVITY
+    if not _ACTIVITY: return
+    batch, _ACTIVITY = _ACTIVITY, {}
+    try:
+        async with db_tx() as db:
+            await db.executemany(_TRACK_SQL, [_activity_params(uid, a) for uid, a in batch.items()])
+    except Exception as e:
+        log.error(f"[activity] flush failed ({len(batch)} users): {e}")
+        # вернуть несохранённые инкременты обратно в буфер
+        for uid, a in batch.items():
+            cur = _ACTIVITY.get(uid)
+            if cur is None:
+                _ACTIVITY[uid] = a
+            else:
+                cur["msg"] += a["msg"]; cur["click"] += a["click"]
+
+async def _activity_flush_loop():
+    while True:
+        try:
+            await asyncio.wait_for(_ACTIVITY_KICK.wait(), TRACK_FLUSH_SEC)
+        except asyncio.TimeoutError:
+            pass
+        _ACTIVITY_KICK.clear()
+        await flush_activity()
+
+def start_activity_flusher():
+    global _ACTIVITY_TASK
+    if _ACTIVITY_TASK is None:
+        _ACTIVITY_TASK = asyncio.create_task(_activity_flush_loop())
+
+async def stop_activity_flusher():
+    global _ACTIVITY_TASK
+    if _ACTIVITY_TASK is not None:
+        _ACTIVITY_TASK.cancel()
+        try: await _ACTIVITY_TASK
+        except asyncio.CancelledError: pass
+        _ACTIVITY_TASK = None
+    await flush_activity()
 
 async def get_user_login(user_id: int) -> Optional[str]:
-    async with aiosqlite.connect(DB_PATH.as_posix()) as db:
-        cur = await db.execute("SELECT login FROM users WHERE id=?", (user_id,))
-        row = await cur.fetchone()
-    return row[0] if row and row[0] else None
+    return (await get_user_state(user_id))["login"]
 
 async def set_user_login(user_id: int, login: str):
-    async with aiosqlite.connect(DB_PATH.as_posix()) as db:
-        await db.execute("UPDATE users SET login=?, verified=0 WHERE id=?", (login, user_id))
-        await db.commit()
+    async with db_tx() as db:
+        await db.execute("UPDATE users SET login=?, verified=0, updated_at=CURRENT_TIMESTAMP WHERE id=?", (login, user_id))
+    _user_cache_set(user_id, login=login, verified=0)
 
 async def clear_user_login(user_id: int):
-    async with aiosqlite.connect(DB_PATH.as_posix()) as db:
-        await db.execute("UPDATE users SET login=NULL, verified=0 WHERE id=?", (user_id,))
-        await db.commit()
+    async with db_tx() as db:
+        await db.execute("UPDATE users SET login=NULL, verified=0, updated_at=CURRENT_TIMESTAMP WHERE id=?", (user_id,))
+    _user_cache_set(user_id, login=None, verified=0)
 
 async def get_profile_by_login(login: str) -> Optional[dict]:
-    async with aiosqlite.connect(DB_PATH.as_posix()) as db:
-        cur = await db.execute("""
-            SELECT login, full_name, position, team, email, phone, manager, vacation_left, salary_usd, extra_json
-            FROM profiles WHERE login=?
-        """, (login,))
-        row = await cur.fetchone()
+    row = await db_fetchone("""
+        SELECT login, full_name, position, team, email, phone, manager, vacation_left, salary_usd, extra_json
+        FROM profiles WHERE login=?
+    """, (login,))
     if not row:
         return None
     keys = ["login","full_name","position","team","email","phone","manager","vacation_left","salary_usd","extra_json"]
@@ -590,31 +1532,137 @@ async def get_profile_by_login(login: str) -> Optional[dict]:
         data["extra"] = {}
     return data
 
+_PROFILE_COLS = ["login","full_name","position","team","email","phone","manager","vacation_left","salary_usd","extra_json"]
+_PROFILE_SET  = ",\n".join(f"  {c}=excluded.{c}" for c in _PROFILE_COLS[1:])
+
+def _profile_params(p: dict) -> tuple:
+    return (
+        p.get("login"), p.get("full_name"), p.get("position"), p.get("team"),
+        p.get("email"), p.get("phone"), p.get("manager"),
+        int(p.get("vacation_left") or 0),
+        int(p.get("salary_usd") or 0),
+        p.get("extra_json"),
+    )
+
+def _profile_hash(params: tuple) -> str:
+    return hashlib.blake2b(json.dumps(params, ensure_ascii=False).encode("utf-8"), digest_size=16).hexdigest()
+
 async def upsert_profiles(profiles: Dict[str, dict]):
+    """Ручная запись (/setprofile, /import_profiles). Такие строки помечаются src_tab='manual'
+    и синком из таблицы не удаляются; row_hash сбрасывается — если логин есть в таблице,
+    следующий синк перезапишет строку оттуда."""
     if not profiles: return
-    async with aiosqlite.connect(DB_PATH.as_posix()) as db:
-        for p in profiles.values():
-            await db.execute("""
-                INSERT INTO profiles (login, full_name, position, team, email, phone, manager, vacation_left, salary_usd, extra_json)
-                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
-                ON CONFLICT(login) DO UPDATE SET
-                  full_name=excluded.full_name,
-                  position=excluded.position,
-                  team=excluded.team,
-                  email=excluded.email,
-                  phone=excluded.phone,
-                  manager=excluded.manager,
-                  vacation_left=excluded.vacation_left,
-                  salary_usd=excluded.salary_usd,
-                  extra_json=excluded.extra_json
-            """, (
-                p.get("login"), p.get("full_name"), p.get("position"), p.get("team"),
-                p.get("email"), p.get("phone"), p.get("manager"),
-                int(p.get("vacation_left") or 0),
-                int(p.get("salary_usd") or 0),
-                p.get("extra_json")
-            ))
-        await db.commit()
+    async with db_tx() as db:
+        await db.executemany(f"""
+            INSERT INTO profiles ({", ".join(_PROFILE_COLS)}, row_hash, src_tab)
+            VALUES ({", ".join("?" * len(_PROFILE_COLS))}, NULL, 'manual')
+            ON CONFLICT(login) DO UPDATE SET
+            {_PROFILE_SET},
+              row_hash=NULL, src_tab='manual'
+        """, [_profile_params(p) for p in profiles.values()])
+
+# ---------- синк профилей из таблицы ----------
+# Строки профилей при разборе вкладок складываются пачками в TEMP-таблицу profile_stage
+# под номером прогона, затем merge_profiles() одной транзакцией: вставляет новые, обновляет
+# строки с другим row_hash, удаляет логины, пропавшие из перечитанных вкладок, и разлогинивает
+# их владельцев. Удаление — только по вкладке, где в этом прогоне есть строки профилей, и
+# только если она сократилась относительно прошлого применённого синка (profile_tabs) не больше
+# чем на PROFILE_PRUNE_MAX_SHARE или на PROFILE_PRUNE_MIN_ROWS строк: обрезанный или пустой
+# экспорт не должен разлогинить всех. Такая вкладка ждёт /refresh force, её база не сдвигается.
+# Профили вне таблицы (src_tab = 'manual') синк не трогает; строки без src_tab (записанные до
+# его появления) забирает самая большая перечитанная вкладка — и удаляет, если их там нет.
+_STAGE_RUN = 0
+
+async def profile_stage_begin() -> int:
+    global _STAGE_RUN
+    async with db_tx() as db:
+        await db.execute("""
+            CREATE TEMP TABLE IF NOT EXISTS profile_stage (
+                run INTEGER NOT NULL,
+                login TEXT NOT NULL,
+                full_name TEXT, position TEXT, team TEXT, email TEXT, phone TEXT, manager TEXT,
+                vacation_left INTEGER, salary_usd INTEGER, extra_json TEXT,
+                row_hash TEXT,
+                src_tab TEXT,
+                PRIMARY KEY (run, login)
+            )
+        """)
+    _STAGE_RUN += 1
+    return _STAGE_RUN
+
+async def profile_stage_drop(run: int):
+    async with db_tx() as db:
+        await db.execute("DELETE FROM profile_stage WHERE run = ?", (run,))
+
+async def stage_profiles(run: int, tab: str, batch: List[dict]):
+    rows = []
+    for p in batch:
+        params = _profile_params(p)
+        rows.append((run, *params, _profile_hash(params), tab))
+    async with db_tx() as db:
+        await db.executemany(f"""
+            INSERT OR REPLACE INTO profile_stage (run, {", ".join(_PROFILE_COLS)}, row_hash, src_tab)
+            VALUES ({", ".join("?" * (len(_PROFILE_COLS) + 3))})
+        """, rows)
+
+async def merge_profiles(run: int, tabs: List[str], force: bool = False) -> dict:
+    """Применяет прогон run из profile_stage. tabs — вкладки, перечитанные целиком в этом синке:
+    из них удаляются логины, которых больше нет в таблице (с оглядкой на защиту выше;
+    force — без неё)."""
+    staged = "SELECT login FROM profile_stage WHERE run = ?"
+    async with db_tx() as db:
+        cur = await db.execute("""
+            SELECT COUNT(*),
+                   COALESCE(SUM(p.login IS NULL), 0),
+                   COALESCE(SUM(p.login IS NOT NULL AND p.row_hash IS NOT s.row_hash), 0)
+            FROM profile_stage s LEFT JOIN profiles p ON p.login = s.login
+            WHERE s.run = ?
+        """, (run,))
+        total, inserted, updated = await cur.fetchone()
+        # «WHERE s.run = ?» заодно нужен парсеру: без WHERE SQLite путает ON CONFLICT с JOIN ... ON
+        await db.execute(f"""
+            INSERT INTO profiles ({", ".join(_PROFILE_COLS)}, row_hash, src_tab)
+            SELECT {", ".join(_PROFILE_COLS)}, row_hash, src_tab FROM profile_stage s WHERE s.run = ?
+            ON CONFLICT(login) DO UPDATE SET
+            {_PROFILE_SET},
+              row_hash=excluded.row_hash, src_tab=excluded.src_tab
+            WHERE profiles.row_hash IS NOT excluded.row_hash OR profiles.src_tab IS NOT excluded.src_tab
+        """, (run,))
+        prune, kept = [], 0
+        if tabs:
+            marks = ", ".join("?" * len(tabs))
+            cur = await db.execute(f"SELECT src_tab, COUNT(*) FROM profile_stage WHERE run = ? AND src_tab IN ({marks}) GROUP BY src_tab", (run, *tabs))
+            fresh = dict(await cur.fetchall())
+            if fresh:
+                await db.execute("UPDATE profiles SET src_tab = ? WHERE src_tab IS NULL", (max(fresh, key=fresh.get),))
+            cur = await db.execute(f"SELECT src_tab, SUM(login NOT IN ({staged})) FROM profiles WHERE src_tab IN ({marks}) GROUP BY src_tab", (run, *tabs))
+            gone = dict(await cur.fetchall())
+            cur = await db.execute(f"SELECT tab, profiles FROM profile_tabs WHERE tab IN ({marks})", tabs)
+            base = dict(await cur.fetchall())
+            for tab in tabs:
+                n, lost, was = fresh.get(tab, 0), gone.get(tab) or 0, base.get(tab)
+                if lost and not force and (not n or (was is not None and was - n > max(PROFILE_PRUNE_MIN_ROWS, PROFILE_PRUNE_MAX_SHARE * was))):
+                    kept += lost
+                    log.warning(f"[gsheet] tab {tab}: {n} profile rows in sheet, {was} at last sync; "
+                                f"not removing {lost} missing logins until /refresh force")
+                    continue
+                if lost:
+                    prune.append(tab)
+                await db.execute("INSERT OR REPLACE INTO profile_tabs (tab, profiles) VALUES (?, ?)", (tab, n))
+        logged_out, removed = [], 0
+        if prune:
+            gone = f"src_tab IN ({', '.join('?' * len(prune))}) AND login NOT IN ({staged})"
+            args = (*prune, run)
+            cur = await db.execute(f"SELECT id FROM users WHERE login IN (SELECT login FROM profiles WHERE {gone})", args)
+            logged_out = [r[0] for r in await cur.fetchall()]
+            if logged_out:
+                await db.execute(f"UPDATE users SET login=NULL, verified=0, updated_at=CURRENT_TIMESTAMP WHERE login IN (SELECT login FROM profiles WHERE {gone})", args)
+            cur = await db.execute(f"DELETE FROM profiles WHERE {gone}", args)
+            removed = cur.rowcount
+    for u in logged_out:
+        user_cache_invalidate(u)
+    return {"inserted": inserted, "updated": updated, "unchanged": total - inserted - updated,
+            "removed": removed, "kept": kept, "logged_out": len(logged_out)}
 
 # ---------- верификация ----------
 def _digits_only(s: str) -> str:
@@ -657,6 +1705,13 @@ def _norm_email(s: str) -> str:
 def _gen_otp_code(n=6) -> str:
     return f"{secrets.randbelow(10**n):0{n}d}"
 
+def _otp_hash(code: str) -> str:
+    # в user_data (а значит, и в БД) лежит только хэш кода
+    return hmac.new(OTP_PEPPER.encode("utf-8"), code.encode("utf-8"), hashlib.sha256).hexdigest()
+
+def _otp_matches(code: str, stored: Optional[str]) -> bool:
+    return bool(code and stored) and hmac.compare_digest(_otp_hash(code), stored)
+
 def _otp_subject(lang: str) -> str:
     return "Код підтвердження HR Assistant" if lang=="uk" else "HR Assistant verification code"
 
@@ -666,44 +1721,296 @@ def _otp_body(lang: str, code: str, ttl_min: int) -> str:
     else:
         return f"Your one-time code: {code}\nValid for {ttl_min} minutes.\nIf you didn’t request it, you can ignore this email."
 
-def _send_email_sync(to_email: str, subject: str, body: str) -> bool:
+# ---------- экспорт CSV ----------
+# Таблица читается кусками по EXPORT_CHUNK (keyset по id, без долгого курсора) и пишется
+# в SpooledTemporaryFile, опционально через gzip: память не растёт с размером таблицы.
+def _parse_since(arg: str) -> Optional[str]:
+    arg = (arg or "").strip()
+    m = re.fullmatch(r"(\d+)\s*([dhm])", arg.lower())
+    if m:
+        sec = int(m[1]) * {"d": 86400, "h": 3600, "m": 60}[m[2]]
+        return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(time.time() - sec))
+    for fmt in ("%Y-%m-%d", "%Y-%m-%d %H:%M", "%Y-%m-%dT%H:%M", "%Y-%m-%d %H:%M:%S", "%Y-%m-%dT%H:%M:%S"):
+        try:
+            return time.strftime("%Y-%m-%d %H:%M:%S", time.strptime(arg, fmt))
+        except ValueError:
+            pass
+    return None
+
+async def export_csv(select_sql: str, header: List[str], where: str = "", params: tuple = (), gz: bool = False,
+                     row_fn: Optional[Callable[[tuple], list]] = None) -> tuple:
+    """(spool, rows): CSV в SpooledTemporaryFile, курсор на начале. Первая колонка select_sql — id.
+    row_fn — преобразование строки БД в строку CSV (курсор по-прежнему по id исходной строки)."""
+    spool = tempfile.SpooledTemporaryFile(max_size=EXPORT_SPOOL_MAX)
+    try:
+        gzf = gzip.GzipFile(fileobj=spool, mode="wb") if gz else None
+        text = io.TextIOWrapper(gzf or spool, encoding="utf-8-sig", newline="")
+        w = csv.writer(text)
+        w.writerow(header)
+        sql = f"{select_sql} WHERE id > ?{' AND ' + where if where else ''} ORDER BY id LIMIT ?"
+        last_id, n = -(2 ** 63), 0
+        while True:
+            rows = await db_fetchall(sql, (last_id, *params, EXPORT_CHUNK))
+            w.writerows(map(row_fn, rows) if row_fn else rows)
+            n += len(rows)
+            if len(rows) < EXPORT_CHUNK:
+                break
+            last_id = rows[-1][0]
+        text.flush()
+        text.detach()   # закрыть обёртку, не закрывая spool / gzip
+        if gzf:
+            gzf.close()   # fileobj, переданный снаружи, GzipFile не закрывает
+        spool.seek(0)
+        return spool, n
+    except Exception:
+        spool.close()
+        raise
+
+def _parse_until(arg: str) -> Optional[str]:
+    """Верхняя граница (не включительно); голая дата — весь этот день включительно."""
+    until = _parse_since(arg)
+    if until and re.fullmatch(r"\d{4}-\d{2}-\d{2}", arg.strip()):
+        ts = calendar.timegm(time.strptime(until, "%Y-%m-%d %H:%M:%S")) + 86400
+        until = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(ts))
+    return until
+
+# ---------- экспорт заявок ----------
+# data_json хранит ответы с подписями полей на языке заполнения, поэтому колонки строятся
+# по текущему определению формы: j-я колонка — j-е поле на любом из языков. Ответы на поля,
+# которых в определении уже нет, уходят JSON-ом в колонку extra — ничего не теряется.
+def _form_columns(form_key: str, lang: str) -> tuple:
+    """(заголовки колонок полей, подписи полей по языкам — сначала язык админа)."""
+    per_lang = [forms_for_lang(l).get(form_key, {}).get("fields") or []
+                for l in (lang, *[x for x in LANGS if x != lang])]
+    width = max(map(len, per_lang), default=0)
+    header = [next((f[j] for f in per_lang if j < len(f)), f"field_{j + 1}") for j in range(width)]
+    return header, per_lang
+
+# created_at — TIMESTAMP (числовая аффинность): граница вида "9999" превратилась бы в число
+# и оказалась меньше любой строки, поэтому «открытый» конец — полная дата-строка.
+_TS_MAX = "9999-12-31 23:59:59"
+
+def _form_row_fn(per_lang: List[List[str]]) -> Callable[[tuple], list]:
+    width = max(map(len, per_lang), default=0)
+    def flatten(r: tuple) -> list:
+        sid, created_at, tg_user_id, username, raw = r
+        try:
+            data = json.loads(raw or "{}")
+        except ValueError:
+            data = {"_raw": raw}
+        if not isinstance(data, dict):
+            data = {"_raw": data}
+        cells = []
+        for j in range(width):
+            label = next((f[j] for f in per_lang if j < len(f) and f[j] in data), None)
+            cells.append(data.pop(label) if label is not None else "")
+        return [sid, created_at, tg_user_id, username, *cells, json.dumps(data, ensure_ascii=False) if data else ""]
+    return flatten
+
+async def _form_id_range(form_key: str, since: Optional[str], until: Optional[str]) -> Optional[tuple]:
+    """Границы id заявок формы в [since, until) — два поиска по idx_forms_key_created."""
+    since, until = since or "", until or _TS_MAX
+    lo = await db_fetchone("SELECT id FROM form_submissions WHERE form_key = ? AND created_at >= ? AND created_at < ? "
+                           "ORDER BY created_at, id LIMIT 1", (form_key, since, until))
+    if not lo:
+        return None
+    hi = await db_fetchone("SELECT id FROM form_submissions WHERE form_key = ? AND created_at >= ? AND created_at < ? "
+                           "ORDER BY created_at DESC, id DESC LIMIT 1", (form_key, since, until))
+    return lo[0], hi[0]
+
+async def export_forms_csv(form_key: str, lang: str, since: Optional[str] = None, until: Optional[str] = None,
+                           gz: bool = False) -> tuple:
+    """(spool, rows): заявки формы за [since, until), по колонке на поле текущего определения."""
+    header, per_lang = _form_columns(form_key, lang)
+    bounds = await _form_id_range(form_key, since, until) or (0, -1)
+    # id растёт вместе с created_at, поэтому диапазон дат — это диапазон id: курсор идёт по
+    # rowid (каждая строка читается один раз), "+form_key" не даёт планировщику уйти в индекс
+    # формы с повторной сортировкой на каждой пачке; created_at перепроверяется на всякий случай.
+    return await export_csv(
+        "SELECT id, created_at, tg_user_id, username, data_json FROM form_submissions",
+        ["id", "created_at", "tg_user_id", "username", *header, "extra"],
+        where="id BETWEEN ? AND ? AND +form_key = ? AND created_at >= ? AND created_at < ?",
+        params=(*bounds, form_key, since or "", until or _TS_MAX), gz=gz, row_fn=_form_row_fn(per_lang))
+
+# ---------- почта: durable outbox + пул SMTP-сессий ----------
+# Хендлер только кладёт письмо в email_outbox и сразу отвечает пользователю.
+# Диспетчер выбирает созревшие письма, SMTP_WORKERS воркеров шлют их, каждый через
+# свою долгоживущую авторизованную сессию (рукопожатие TLS + AUTH — раз на сессию,
+# а не на письмо). Ошибки — повтор с экспоненциальной паузой; неотправленные письма
+# переживают рестарт. Тело письма (там код) после отправки / отказа затирается.
+class _SmtpSession:
+    """Синхронная SMTP-сессия; методы зовутся через asyncio.to_thread одним воркером."""
+    def __init__(self):
+        self.conn: Optional[smtplib.SMTP] = None
+        self.used = 0.0
+
+    def _connect(self):
+        if SMTP_USE_SSL:
+            conn = smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, timeout=20)
+        else:
+            conn = smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=20)
+            conn.ehlo()
+            if SMTP_STARTTLS:
+                conn.starttls()
+                conn.ehlo()
+        if SMTP_USER:
+            conn.login(SMTP_USER, SMTP_PASS)
+        self.conn = conn
+
+    def close(self):
+        if self.conn is not None:
+            try: self.conn.quit()
+            except Exception:
+                try: self.conn.close()
+                except Exception: pass
+            self.conn = None
+
+    def send(self, msg: EmailMessage):
+        if self.conn is not None and time.monotonic() - self.used > SMTP_IDLE_SEC:
+            try:   # после простоя сервер мог молча закрыть сессию
+                if self.conn.noop()[0] != 250: self.close()
+            except Exception:
+                self.close()
+        fresh = self.conn is None
+        if fresh:
+            self._connect()
+        try:
+            self.conn.send_message(msg)
+        except (smtplib.SMTPServerDisconnected, ConnectionError, TimeoutError):
+            self.close()
+            if fresh:
+                raise
+            self._connect()   # старая сессия отвалилась — одна попытка через новую
+            self.conn.send_message(msg)
+        self.used = time.monotonic()
+
+def _email_permanent(e: Exception) -> bool:
+    if isinstance(e, smtplib.SMTPRecipientsRefused):
+        return True
+    return isinstance(e, (smtplib.SMTPSenderRefused, smtplib.SMTPDataError)) and e.smtp_code >= 500
+
+_EMAIL_KICK = asyncio.Event()
+_EMAIL_TASKS: List[asyncio.Task] = []
+
+async def enqueue_email(to_email: str, subject: str, body: str, user_id: Optional[int] = None,
+                        lang: str = "es", ttl_sec: Optional[int] = None) -> int:
+    """Кладёт письмо в outbox. ttl_sec — не отправлять позже (OTP к тому времени уже протух)."""
+    now = time.time()
+    async with db_tx() as db:
+        cur = await db.execute("""
+            INSERT INTO email_outbox (to_email, subject, body, tg_user_id, lang, next_try_at, expires_at)
+            VALUES (?, ?, ?, ?, ?, ?, ?)
+        """, (to_email, subject, body, user_id, lang, now, now + ttl_sec if ttl_sec else None))
+        oid = cur.lastrowid
+    _EMAIL_KICK.set()
+    return oid
+
+async def _outbox_finish(oid: int, status: str, attempts: int, error: Optional[str] = None):
+    async with db_tx() as db:
+        await db.execute("""
+            UPDATE email_outbox SET status=?, attempts=?, last_error=?, body='', done_at=CURRENT_TIMESTAMP
+            WHERE id=?
+        """, (status, attempts, error, oid))
+
+async def _email_dispatcher(queue: asyncio.Queue):
+    async with db_tx() as db:   # письма, взятые в работу до рестарта, отправляются заново
+        await db.execute("UPDATE email_outbox SET status='pending' WHERE status='sending'")
+    while True:
+        try:
+            _EMAIL_KICK.clear()
+            now = time.time()
+            async with db_tx() as db:
+                cur = await db.execute("""
+                    SELECT id, to_email, subject, body, attempts, tg_user_id, lang, expires_at FROM email_outbox
+                    WHERE status='pending' AND next_try_at<=? ORDER BY id LIMIT 100
+                """, (now,))
+                rows = await cur.fetchall()
+                await db.executemany("UPDATE email_outbox SET status='sending' WHERE id=?", [(r[0],) for r in rows])
+            for r in rows:
+                queue.put_nowait(r)
+            nxt = await db_fetchone("SELECT MIN(next_try_at) FROM email_outbox WHERE status='pending' AND next_try_at>?", (now,))
+            wait = min(30.0, nxt[0] - now) if nxt and nxt[0] is not None else 30.0
+            with contextlib.suppress(asyncio.TimeoutError):
+                await asyncio.wait_for(_EMAIL_KICK.wait(), timeout=max(0.05, wait))
+        except Exception:   # сбой БД не должен навсегда останавливать рассылку
+            log.exception("[email] dispatcher iteration failed")
+            await asyncio.sleep(5)
+
+async def _email_worker(bot, queue: asyncio.Queue):
+    session = _SmtpSession()
+    try:
+        while True:
+            oid, to_email, subject, body, attempts, uid, lang, expires_at = await queue.get()
+            try:
+                await _deliver_email(bot, session, oid, to_email, subject, body, attempts, uid, lang, expires_at)
+            except Exception as e:
+                log.error(f"[email] outbox #{oid}: {e}")
+    finally:
+        await asyncio.to_thread(session.close)
+
+async def _deliver_email(bot, session: _SmtpSession, oid: int, to_email: str, subject: str, body: str,
+                         attempts: int, uid: Optional[int], lang: str, expires_at: Optional[float]):
+    if expires_at and time.time() > expires_at:
+        await _outbox_finish(oid, "expired", attempts)
+        log.warning(f"[email] outbox #{oid} to {to_email} expired before delivery")
+        return
     msg = EmailMessage()
     msg["From"] = SMTP_FROM
     msg["To"] = to_email
     msg["Subject"] = subject
     msg.set_content(body)
-
+    t0 = time.perf_counter()
     try:
-        if SMTP_USE_SSL:
-            with smtplib.SMTP_SSL(SMTP_HOST, SMTP_PORT, timeout=20) as s:
-                if SMTP_USER:
-                    s.login(SMTP_USER, SMTP_PASS)
-                s.send_message(msg)
-        else:
-            with smtplib.SMTP(SMTP_HOST, SMTP_PORT, timeout=20) as s:
-                s.ehlo()
-                s.starttls()
-                if SMTP_USER:
-                    s.login(SMTP_USER, SMTP_PASS)
-                s.send_message(msg)
-        return True
+        if not SMTP_HOST:
+            raise RuntimeError("SMTP_HOST is empty")
+        await asyncio.to_thread(session.send, msg)
+        SMTP_SEND_SECONDS.observe(time.perf_counter() - t0, "ok")
     except Exception as e:
-        log.error(f"[email] send failed: {e}")
-        return False
+        SMTP_SEND_SECONDS.observe(time.perf_counter() - t0, "error")
+        attempts += 1
+        permanent = _email_permanent(e) or not SMTP_HOST
+        if not permanent:
+            await asyncio.to_thread(session.close)
+        SMTP_FAILURES.inc("failed" if permanent or attempts >= EMAIL_MAX_ATTEMPTS else "retry")
+        if permanent or attempts >= EMAIL_MAX_ATTEMPTS:
+            await _outbox_finish(oid, "failed", attempts, str(e))
+            log.error(f"[email] outbox #{oid} to {to_email} failed: {e}")
+            if uid and bot:
+                txt = "❌ Не вдалося надіслати код. Спробуйте ще раз: /verify" if lang=="uk" else "❌ Failed to send the code. Try again: /verify"
+                with contextlib.suppress(Exception):
+                    await bot.send_message(uid, txt)
+            return
+        delay = EMAIL_RETRY_BASE_SEC * (2 ** (attempts - 1))
+        async with db_tx() as db:
+            await db.execute("UPDATE email_outbox SET status='pending', attempts=?, last_error=?, next_try_at=? WHERE id=?",
+                             (attempts, str(e), time.time() + delay, oid))
+        log.warning(f"[email] outbox #{oid} to {to_email}: {e}; retry in {delay:.1f}s")
+        _EMAIL_KICK.set()
+        return
+    await _outbox_finish(oid, "sent", attempts + 1)
+    log.info(f"[email] outbox #{oid} sent to {to_email}")
 
-async def send_email(to_email: str, subject: str, body: str) -> bool:
-    return await asyncio.to_thread(_send_email_sync, to_email, subject, body)
+def start_email_worker(bot):
+    if _EMAIL_TASKS:
+        return
+    queue: asyncio.Queue = asyncio.Queue()
+    _EMAIL_TASKS.append(asyncio.create_task(_email_dispatcher(queue)))
+    for _ in range(max(1, SMTP_WORKERS)):
+        _EMAIL_TASKS.append(asyncio.create_task(_email_worker(bot, queue)))
+
+async def stop_email_worker():
+    for t in _EMAIL_TASKS:
+        t.cancel()
+    await asyncio.gather(*_EMAIL_TASKS, return_exceptions=True)
+    _EMAIL_TASKS.clear()
 
 async def set_verified(user_id: int, value: int):
-    async with aiosqlite.connect(DB_PATH.as_posix()) as db:
-        await db.execute("UPDATE users SET verified=? WHERE id=?", (value, user_id))
-        await db.commit()
+    async with db_tx() as db:
+        await db.execute("UPDATE users SET verified=?, updated_at=CURRENT_TIMESTAMP WHERE id=?", (value, user_id))
+    _user_cache_set(user_id, verified=int(value))
 
 async def get_verified(user_id: int) -> int:
-    async with aiosqlite.connect(DB_PATH.as_posix()) as db:
-        cur = await db.execute("SELECT verified FROM users WHERE id=?", (user_id,))
-        row = await cur.fetchone()
-    return int(row[0]) if row and row[0] is not None else 0
+    return (await get_user_state(user_id))["verified"]
 
 async def is_verified(user_id: int) -> bool:
     return (await get_verified(user_id)) >= 1
@@ -778,6 +2085,7 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
 async def login_step(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    metrics_route("login_step")
     uid = update.effective_user.id
     lang = await get_pref_lang(uid)
     login_text = (update.message.text or "").strip()
@@ -809,14 +2117,12 @@ async def cmd_resend(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     code = _gen_otp_code(6)
-    vf["otp"] = code
+    vf["otp"] = _otp_hash(code)
     vf["otp_sent_ts"] = int(time.time())
     vf["resends"] = int(vf.get("resends") or 0) + 1
-    sent = await send_email(vf["email"], _otp_subject(lang), _otp_body(lang, code, OTP_TTL_MIN))
-    if sent:
-        await update.message.reply_text("✅ Новий код надіслано. Перевірте пошту." if lang=="uk" else "✅ New code sent. Check your email.")
-    else:
-        await update.message.reply_text("❌ Не вдалося надіслати новий код." if lang=="uk" else "❌ Failed to resend code.")
+    await enqueue_email(vf["email"], _otp_subject(lang), _otp_body(lang, code, OTP_TTL_MIN),
+                        user_id=update.effective_user.id, lang=lang, ttl_sec=OTP_TTL_MIN*60)
+    await update.message.reply_text("✅ Новий код надіслано. Перевірте пошту." if lang=="uk" else "✅ New code sent. Check your email.")
 
 async def cmd_myid(update: Update, context: ContextTypes.DEFAULT_TYPE):
     lang = await get_pref_lang(update.effective_user.id)
@@ -835,13 +2141,14 @@ async def cmd_logout(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text("🔐 Введіть свій <b>корпоративний логін</b>:" if lang=="uk" else "🔐 Introduce tu <b>login corporativo</b>:", parse_mode="HTML")
     return LOGIN
 
-async def _start_form_fill(update_or_query, context: ContextTypes.DEFAULT_TYPE, lang: str, key: str):
-    f = forms_for_lang(lang).get(key)
+async def _start_form_fill(update_or_query, context: ContextTypes.DEFAULT_TYPE, lang: str, key: str,
+                           snap: Optional[ContentSnapshot] = None):
+    f = forms_for_lang(lang, snap).get(key)
     if not f:
         return
     fields = f.get("fields", [])
     if not fields:
-        txt = _form_info_text(lang, key)
+        txt = _form_info_text(lang, key, snap)
         if isinstance(update_or_query, Update) and update_or_query.message:
             await update_or_query.message.reply_text(txt, parse_mode="HTML")
         else:
@@ -858,12 +2165,11 @@ async def _start_form_fill(update_or_query, context: ContextTypes.DEFAULT_TYPE,
         await show_loader_and_edit(q, prompt, reply_markup=None, parse_mode="HTML", lang=lang)
 
 async def save_form_submission(user_id: int, username: str, form_key: str, data_dict: dict):
-    async with aiosqlite.connect(DB_PATH.as_posix()) as db:
+    async with db_tx() as db:
         await db.execute("""
             INSERT INTO form_submissions (tg_user_id, username, form_key, data_json)
             VALUES (?, ?, ?, ?)
         """, (user_id, username or "", form_key, json.dumps(data_dict, ensure_ascii=False)))
-        await db.commit()
 
 # ---------- единый обработчик кнопок ----------
 async def on_menu_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -875,6 +2181,7 @@ async def on_menu_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
     data = query.data
     uid  = update.effective_user.id
     lang = await get_pref_lang(uid)
+    snap = CONTENT
 
     # Переключение языка
     if data in ("lang_es", "lang_uk"):
@@ -882,19 +2189,19 @@ async def on_menu_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
         lang = await get_pref_lang(uid)
         if not await is_verified(uid) and not is_admin(uid):
             await start_verification_flow(query, context); return
-        await show_loader_and_edit(query, TX["menu_main"][lang], reply_markup=await kb_main_for(uid), lang=lang); return
+        await show_loader_and_edit(query, TX["menu_main"][lang], reply_markup=kb_main_for(uid), lang=lang); return
 
     # Обработка «Назад»
     if data.startswith("back_to:"):
         target = data.split(":",1)[1]
         if target == "main":
-            await show_loader_and_edit(query, TX["menu_main"][lang], reply_markup=await kb_main_for(uid), lang=lang); return
+            await show_loader_and_edit(query, TX["menu_main"][lang], reply_markup=kb_main_for(uid), lang=lang); return
         elif target == "menu_quick":
-            await show_loader_and_edit(query, TX["menu_quick_title"][lang], kb_quick(lang), lang=lang); return
+            await show_loader_and_edit(query, TX["menu_quick_title"][lang], kb_quick(lang, snap), lang=lang); return
         elif target == "menu_forms":
-            await show_loader_and_edit(query, TX["menu_forms_title"][lang], kb_forms_info(lang), lang=lang); return
+            await show_loader_and_edit(query, TX["menu_forms_title"][lang], kb_forms_info(lang, snap), lang=lang); return
         else:
-            await show_loader_and_edit(query, TX["menu_main"][lang], reply_markup=await kb_main_for(uid), lang=lang); return
+            await show_loader_and_edit(query, TX["menu_main"][lang], reply_markup=kb_main_for(uid), lang=lang); return
 
     # Верификация
     if data == "start_verify":
@@ -903,13 +2210,13 @@ async def on_menu_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # Главные пункты
     if data == "menu_quick":
         if not is_admin(uid) and not await is_verified(uid):
-            await show_loader_and_edit(query, "🔒 Спершу пройдіть верифікацію: натисніть «Верифікація».", reply_markup=await kb_main_for(uid), lang=lang); return
-        await show_loader_and_edit(query, TX["menu_quick_title"][lang], kb_quick(lang), lang=lang); return
+            await show_loader_and_edit(query, "🔒 Спершу пройдіть верифікацію: натисніть «Верифікація».", reply_markup=kb_main_for(uid), lang=lang); return
+        await show_loader_and_edit(query, TX["menu_quick_title"][lang], kb_quick(lang, snap), lang=lang); return
 
     if data == "menu_forms":
         if not is_admin(uid) and not await is_verified(uid):
-            await show_loader_and_edit(query, "🔒 Спершу пройдіть верифікацію: натисніть «Верифікація».", reply_markup=await kb_main_for(uid), lang=lang); return
-        await show_loader_and_edit(query, TX["menu_forms_title"][lang], kb_forms_info(lang), lang=lang); return
+            await show_loader_and_edit(query, "🔒 Спершу пройдіть верифікацію: натисніть «Верифікація».", reply_markup=kb_main_for(uid), lang=lang); return
+        await show_loader_and_edit(query, TX["menu_forms_title"][lang], kb_forms_info(lang, snap), lang=lang); return
 
     # Профиль
     if data == "menu_profile":
@@ -918,32 +2225,45 @@ async def on_menu_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
             await show_loader_and_edit(query, "🔐 Введіть свій <b>корпоративний логін</b>:" if lang=="uk" else "🔐 Introduce tu <b>login corporativo</b>:", reply_markup=None, lang=lang); return
         prof = await get_profile_by_login(login)
         if not prof:
-            await show_loader_and_edit(query, "❌ Профіль не знайдено." if lang=="uk" else "❌ Perfil no encontrado.", reply_markup=await kb_main_for(uid), lang=lang); return
+            await show_loader_and_edit(query, "❌ Профіль не знайдено." if lang=="uk" else "❌ Perfil no encontrado.", reply_markup=kb_main_for(uid), lang=lang); return
         await show_loader_and_edit(query, profile_card(lang, prof), reply_markup=kb_back_to("main", lang), parse_mode="HTML", lang=lang); return
 
     # Меню выбора способа заполнения формы
     if data.startswith("formchoice_"):
         if not is_admin(uid) and not await is_verified(uid):
-            await show_loader_and_edit(query, "🔒 Спершу пройдіть верифікацію.", reply_markup=await kb_main_for(uid), lang=lang); return
+            await show_loader_and_edit(query, "🔒 Спершу пройдіть верифікацію.", reply_markup=kb_main_for(uid), lang=lang); return
         key = data.split("_", 1)[1]
-        text = _form_choice_text(lang, key)
-        await show_loader_and_edit(query, text, reply_markup=kb_form_choice(lang, key), parse_mode="HTML", lang=lang); return
+        text = _form_choice_text(lang, key, snap)
+        await show_loader_and_edit(query, text, reply_markup=kb_form_choice(lang, key, snap), parse_mode="HTML", lang=lang); return
 
     # Пошаговое заполнение в боте
     if data.startswith("formfill_"):
         if not is_admin(uid) and not await is_verified(uid):
-            await show_loader_and_edit(query, "🔒 Спершу пройдіть верифікацію.", reply_markup=await kb_main_for(uid), lang=lang); return
+            await show_loader_and_edit(query, "🔒 Спершу пройдіть верифікацію.", reply_markup=kb_main_for(uid), lang=lang); return
         key = data.split("_", 1)[1]
-        await _start_form_fill(query, context, lang, key); return
+        await _start_form_fill(query, context, lang, key, snap); return
+
+    # Листание /users (админ)
+    if data.startswith("users:"):
+        if not is_admin(uid): return
+        # callback_data могла устареть или быть подделана: limit — как в cmd_users, курсор проверит users_page
+        direction, limit, cursor = (data.split(":", 3) + ["", "", ""])[1:4]
+        try:
+            limit = max(1, min(int(limit), 100))
+        except ValueError:
+            limit = 20
+        await flush_activity()
+        text, markup = await users_page(lang, limit, direction, cursor)
+        await show_loader_and_edit(query, text, reply_markup=markup, parse_mode="HTML", lang=lang); return
 
     # FAQ
     if data.startswith("faq_"):
         if not is_admin(uid) and not await is_verified(uid):
             warn = "🔒 Спершу пройдіть верифікацію: натисніть «Верифікація»." if lang=="uk" else "🔒 Primero completa la verificación."
-            await show_loader_and_edit(query, warn, reply_markup=await kb_main_for(uid), lang=lang); return
+            await show_loader_and_edit(query, warn, reply_markup=kb_main_for(uid), lang=lang); return
         token = data.split("_", 1)[1]
-        key = CB_MAP.get(lang, {}).get(token)
-        KB  = kb_for_lang(lang)
+        key = snap.cb_map.get(lang, {}).get(token)
+        KB  = kb_for_lang(lang, snap)
         info = KB.get(key) if key else None
         txt  = to_html(_clean_text(info["response"])) if info else "—"
         # Показать контент + «Назад» в быстрые темы
@@ -953,11 +2273,11 @@ async def on_menu_click(update: Update, context: ContextTypes.DEFAULT_TYPE):
 async def free_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await track_user(update, inc_msg=1)
     lang = await get_pref_lang(update.effective_user.id)
-    await update.message.chat.send_action(ChatAction.TYPING)
 
     # 1) Верификация шаги
     vf = context.user_data.get("verify")
     if vf:
+        metrics_route("free_text", "verify")
         try:
             txt = (update.message.text or "").strip()
             step = int(vf.get("step") or 1)
@@ -985,20 +2305,16 @@ async def free_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
                 vf["email"] = email
                 code = _gen_otp_code(6)
-                vf["otp"] = code
+                vf["otp"] = _otp_hash(code)
                 vf["otp_sent_ts"] = int(time.time())
                 vf["attempts"] = 0
                 vf["resends"] = 0
-                sent = await send_email(email, _otp_subject(lang), _otp_body(lang, code, OTP_TTL_MIN))
-                if sent:
-                    log.info(f"[verify] otp sent to {email}")
-                    msg = "✅ Код надіслано на пошту. Введіть його тут." if lang=="uk" else "✅ Code sent to your email. Enter it here."
-                    vf["step"] = 3
-                    await update.message.reply_text(msg)
-                else:
-                    log.error(f"[verify] otp send failed to {email}")
-                    msg = "❌ Не вдалося надіслати код. Спробуйте ще раз." if lang=="uk" else "❌ Failed to send the code. Try again."
-                    await update.message.reply_text(msg)
+                await enqueue_email(email, _otp_subject(lang), _otp_body(lang, code, OTP_TTL_MIN),
+                                    user_id=update.effective_user.id, lang=lang, ttl_sec=OTP_TTL_MIN*60)
+                log.info(f"[verify] otp queued for {email}")
+                msg = "✅ Код надіслано на пошту. Введіть його тут." if lang=="uk" else "✅ Code sent to your email. Enter it here."
+                vf["step"] = 3
+                await update.message.reply_text(msg)
                 return
 
             # шаг 3 — проверка кода
@@ -1011,7 +2327,7 @@ async def free_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
                     return
 
                 code = (txt.replace(" ", "") or "")
-                good = (code and vf.get("otp") and code == vf["otp"])
+                good = _otp_matches(code, vf.get("otp"))
                 fresh = (int(time.time()) - int(vf.get("otp_sent_ts") or 0) <= OTP_TTL_MIN*60)
 
                 if good and fresh:
@@ -1033,6 +2349,7 @@ async def free_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # 2) Идёт заполнение формы?
     ff = context.user_data.get("form_fill")
     if ff:
+        metrics_route("free_text", "form")
         i = ff["i"]
         fields = ff["fields"]
         key = ff["key"]
@@ -1058,6 +2375,7 @@ async def free_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     # 3) Если нет логина — трактуем как логин
     login = await get_user_login(update.effective_user.id)
     if not login:
+        metrics_route("free_text", "login")
         candidate = (update.message.text or "").strip()
         prof = await get_profile_by_login(candidate)
         if prof:
@@ -1070,19 +2388,35 @@ async def free_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     # 4) Гейт: ответы только после верификации (кроме админов)
     if not is_admin(update.effective_user.id) and not await is_verified(update.effective_user.id):
+        metrics_route("free_text", "gate")
         note = "🔒 Щоб отримати відповіді, пройдіть верифікацію (кнопка в меню)." if lang=="uk" else "🔒 Para ver respuestas, completa la verificación (botón en el menú)."
         await update.message.reply_text(note, reply_markup=await kb_main_for(update.effective_user.id))
         return
 
     # 5) Обычный FAQ-поиск
+    metrics_route("free_text", "faq")
     text = update.message.text or ""
-    hit = find_best_match(text, lang)
-    await asyncio.sleep(0.1)
+    snap = CONTENT
+    if FAQ_SEARCH_MODE == "ranked":
+        ranked = search_faq(text, lang, snap=snap)
+        if len(ranked) > 1 and ranked[1][1] >= FAQ_AMBIGUOUS_RATIO * ranked[0][1]:
+            await update.message.reply_text("🔎 Можливо, ви шукаєте:" if lang=="uk" else "🔎 Quizás buscas:",
+                                            reply_markup=kb_faq_results(lang, [key for key, _ in ranked], snap))
+            return
+        if ranked:
+            entry = kb_for_lang(lang, snap).get(ranked[0][0])
+            if entry:
+                await update.message.reply_text(to_html(_clean_text(entry["response"])), parse_mode="HTML",
+                                                reply_markup=kb_back_to("main", lang),
+                                                disable_web_page_preview=True)
+                return
+    hit = find_best_match(text, lang, snap)
     if hit:
         await update.message.reply_text(to_html(_clean_text(hit)), parse_mode="HTML",
                                         reply_markup=kb_back_to("main", lang),
                                         disable_web_page_preview=True)
     else:
+        metrics_route("free_text", "fallback")
         await update.message.reply_text(TX["start_banner"][lang], parse_mode="HTML",
                                         reply_markup=await kb_main_for(update.effective_user.id),
                                         disable_web_page_preview=True)
@@ -1113,62 +2447,150 @@ async def cmd_stats(update: Update, context: ContextTypes.DEFAULT_TYPE):
     lang = await get_pref_lang(uid)
     if not is_admin(uid):
         await update.message.reply_text("⛔ Недостатньо прав (лише для адміністраторів)." if lang=="uk" else "⛔ Sin permisos (solo para administradores)."); return
-    async with aiosqlite.connect(DB_PATH.as_posix()) as db:
-        cur = await db.execute("SELECT COUNT(*) FROM users"); total_users = (await cur.fetchone())[0]
-        cur = await db.execute("SELECT COUNT(*) FROM users WHERE last_seen >= datetime('now','-7 day')"); weekly = (await cur.fetchone())[0]
-        cur = await db.execute("SELECT IFNULL(SUM(msg_count),0), IFNULL(SUM(click_count),0) FROM users"); msg_sum, click_sum = await cur.fetchone()
+    await flush_activity()
+    total_users, msg_sum, click_sum = await db_fetchone("SELECT users, msgs, clicks FROM stats_totals WHERE id = 1") or (0, 0, 0)
+    day = lambda n: time.strftime("%Y-%m-%d", time.gmtime(time.time() - n * 86400))
+    d1, d7, d30 = await db_fetchone("""
+        SELECT IFNULL(SUM(n * (day >= ?)), 0), IFNULL(SUM(n * (day >= ?)), 0), IFNULL(SUM(n), 0)
+        FROM users_by_last_day WHERE day >= ?
+    """, (day(0), day(6), day(29)))
+    trend = await db_fetchall("SELECT day, active_users, new_users FROM daily_stats WHERE day >= ? ORDER BY day", (day(6),))
     txt = ("📊 <b>Статистика</b>" if lang=="uk" else "📊 <b>Estadísticas</b>") + "\n" + \
-          ("• Користувачів всього: <b>{u}</b>\n• Активні за 7 днів: <b>{w}</b>\n• Повідомлень: <b>{m}</b>\n• Кліків: <b>{c}</b>\n"
+          ("• Користувачів всього: <b>{u}</b>\n• Активні сьогодні / 7 / 30 днів: <b>{d1}</b> / <b>{w}</b> / <b>{d30}</b>\n• Повідомлень: <b>{m}</b>\n• Кліків: <b>{c}</b>\n"
            if lang=="uk" else
-           "• Usuarios totales: <b>{u}</b>\n• Activos 7 días: <b>{w}</b>\n• Mensajes: <b>{m}</b>\n• Clicks: <b>{c}</b>\n").format(u=total_users,w=weekly,m=msg_sum,c=click_sum)
+           "• Usuarios totales: <b>{u}</b>\n• Activos hoy / 7 / 30 días: <b>{d1}</b> / <b>{w}</b> / <b>{d30}</b>\n• Mensajes: <b>{m}</b>\n• Clicks: <b>{c}</b>\n").format(u=total_users,d1=d1,w=d7,d30=d30,m=msg_sum,c=click_sum)
+    if trend:
+        txt += ("\n📈 <b>Активні (нові) по днях, UTC</b>\n" if lang=="uk" else "\n📈 <b>Activos (nuevos) por día, UTC</b>\n") + \
+               "\n".join(f"<code>{d[5:]}</code> {a} ({n})" for d, a, n in trend)
     await update.message.reply_html(txt, reply_markup=await kb_main_for(uid))
 
-async def cmd_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
-    uid = update.effective_user.id
-    lang = await get_pref_lang(uid)
-    if not is_admin(uid):
-        await update.message.reply_text("⛔ Недостатньо прав (лише для адміністраторів)." if lang=="uk" else "⛔ Sin permisos (solo para administradores)."); return
-    try:
-        offset = int(context.args[0]) if len(context.args) >= 1 else 0
-        limit  = int(context.args[1]) if len(context.args) >= 2 else 20
-        limit  = max(1, min(limit, 100))
-    except:
-        offset, limit = 0, 20
-    async with aiosqlite.connect(DB_PATH.as_posix()) as db:
-        cur = await db.execute("""
-            SELECT id, username, first_name, last_name, language_code, msg_count, click_count, last_seen, login
-            FROM users ORDER BY last_seen DESC LIMIT ? OFFSET ?;
-        """, (limit, offset))
-        rows = await cur.fetchall()
+# /users листается по курсору (last_seen, id) вместо OFFSET: страница N стоит столько же,
+# сколько первая, а пользователь, ставший активным, уходит наверх, а не сдвигает страницы.
+# Курсор едет в callback_data кнопок ◀ / ▶: "users:n|p:<limit>:<last_seen цифрами>.<id>".
+# Колонки страницы входят в idx_users_last_seen (миграция 7) — при правке держать их в паре.
+_USERS_COLS = "id, username, first_name, last_name, language_code, msg_count, click_count, last_seen, login"
+# (last_seen, id) < курсора = «тот же last_seen, id меньше» ∪ «last_seen меньше»: обе части —
+# точный поиск по idx_users_last_seen, без перебора строк с одинаковым last_seen
+_USERS_SEEK_SQL = f"""
+    SELECT * FROM (
+        SELECT * FROM (SELECT {_USERS_COLS} FROM users WHERE last_seen = ? AND id {{cmp}} ? ORDER BY id {{order}} LIMIT ?)
+        UNION ALL
+        SELECT * FROM (SELECT {_USERS_COLS} FROM users WHERE last_seen {{cmp}} ? ORDER BY last_seen {{order}}, id {{order}} LIMIT ?)
+    ) ORDER BY last_seen {{order}}, id {{order}} LIMIT ?
+"""
+
+async def _users_fetch(n: int, seek: Optional[tuple] = None, older: bool = True) -> list:
+    if seek is None:
+        return await db_fetchall(f"SELECT {_USERS_COLS} FROM users ORDER BY last_seen DESC, id DESC LIMIT ?", (n,))
+    ts, rid = seek
+    sql = _USERS_SEEK_SQL.format(cmp="<" if older else ">", order="DESC" if older else "ASC")
+    return await db_fetchall(sql, (ts, rid, n, ts, n, n))
+
+def _users_cursor(row) -> str:
+    return "".join(ch for ch in (row[7] or "") if ch.isdigit()) + f".{row[0]}"
+
+def _parse_users_cursor(c: Optional[str]) -> Optional[tuple]:
+    """(last_seen, id) из курсора; None — курсор битый (или строка без last_seen), листаем с начала."""
+    if not c or not re.fullmatch(r"\d{14}\.\d+", c):
+        return None
+    ts, _, rid = c.partition(".")
+    return f"{ts[0:4]}-{ts[4:6]}-{ts[6:8]} {ts[8:10]}:{ts[10:12]}:{ts[12:14]}", int(rid)
+
+async def users_page(lang: str, limit: int, direction: str = "first", cursor: Optional[str] = None) -> tuple:
+    """(text, markup) страницы /users. direction: first | n (старше курсора) | p (новее курсора)."""
+    has_prev = has_next = False
+    rows = []
+    seek = _parse_users_cursor(cursor)
+    if direction == "n" and seek:
+        rows = await _users_fetch(limit + 1, seek, older=True)
+        has_prev, has_next = True, len(rows) > limit
+        rows = rows[:limit]
+    elif direction == "p" and seek:
+        rows = await _users_fetch(limit + 1, seek, older=False)
+        if len(rows) > limit:
+            has_prev, has_next = True, True
+            rows = rows[:limit][::-1]
+        else:
+            rows = []   # дошли до начала — показываем первую страницу целиком
+    if not rows:
+        rows = await _users_fetch(limit + 1)
+        has_prev, has_next = False, len(rows) > limit
+        rows = rows[:limit]
     if not rows:
-        await update.message.reply_text("Порожньо." if lang=="uk" else "Vacío.", reply_markup=await kb_main_for(uid)); return
+        return ("Порожньо." if lang=="uk" else "Vacío."), kb_back_to("main", lang)
     lines = []
     for uid2, username, fn, ln, tl, msgc, clk, last, login in rows:
         handle = f"@{username}" if username else ("(без username)" if lang=="uk" else "(sin username)")
         name = " ".join([x for x in [fn, ln] if x]).strip() or "—"
         login_s = login or "—"
-        lines.append(f"• <b>{name}</b> {handle}\n  id: <code>{uid2}</code> | login: <code>{html.escape(login_s)}</code> | lang: {html.escape(tl or '—')} | msg: {msgc} | click: {clk} | last: {last}")
+        lines.append(f"• <b>{html.escape(name)}</b> {html.escape(handle)}\n  id: <code>{uid2}</code> | login: <code>{html.escape(login_s)}</code> | lang: {html.escape(tl or '—')} | msg: {msgc} | click: {clk} | last: {last}")
     title = ("👥 <b>Користувачі</b>\n" if lang=="uk" else "👥 <b>Usuarios</b>\n")
-    nav = f"\n\n/users {offset+limit} {limit} ▶"
-    await update.message.reply_html(title + "\n".join(lines) + nav, reply_markup=await kb_main_for(uid))
+    nav = []
+    if has_prev: nav.append(InlineKeyboardButton("◀", callback_data=f"users:p:{limit}:{_users_cursor(rows[0])}"))
+    if has_next: nav.append(InlineKeyboardButton("▶", callback_data=f"users:n:{limit}:{_users_cursor(rows[-1])}"))
+    markup = InlineKeyboardMarkup(([nav] if nav else []) + list(kb_back_to("main", lang).inline_keyboard))
+    return title + "\n".join(lines), markup
+
+async def cmd_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    lang = await get_pref_lang(uid)
+    if not is_admin(uid):
+        await update.message.reply_text("⛔ Недостатньо прав (лише для адміністраторів)." if lang=="uk" else "⛔ Sin permisos (solo para administradores)."); return
+    try:
+        limit = int(context.args[-1]) if context.args else 20   # старая форма «/users <offset> <limit>» тоже годится
+        limit = max(1, min(limit, 100))
+    except:
+        limit = 20
+    await flush_activity()
+    text, markup = await users_page(lang, limit)
+    await update.message.reply_html(text, reply_markup=markup)
 
 async def cmd_export_users(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
     lang = await get_pref_lang(uid)
     if not is_admin(uid):
         await update.message.reply_text("⛔ Недостатньо прав (лише для адміністраторів)." if lang=="uk" else "⛔ Sin permisos (solo para administradores)."); return
-    async with aiosqlite.connect(DB_PATH.as_posix()) as db:
-        cur = await db.execute("""
-            SELECT id, username, first_name, last_name, language_code, pref_lang, login, verified, is_bot, first_seen, last_seen, msg_count, click_count
-            FROM users ORDER BY last_seen DESC
-        """)
-        rows = await cur.fetchall()
-    buf = StringIO(); w = csv.writer(buf)
-    w.writerow(["id","username","first_name","last_name","language_code","pref_lang","login","verified","is_bot","first_seen","last_seen","msg_count","click_count"])
-    for r in rows: w.writerow(r)
-    data_bytes = buf.getvalue().encode("utf-8-sig")
-    bio = BytesIO(data_bytes); bio.name = "users_export.csv"
-    await update.message.reply_document(document=InputFile(bio), caption="Експорт" if lang=="uk" else "Export")
+    # /export_users [since] [gz]: since — 7d / 12h / 30m или дата UTC (2024-05-01, 2024-05-01T10:00)
+    gz = any(a.lower() in ("gz", "gzip") for a in context.args)
+    rest = [a for a in context.args if a.lower() not in ("gz", "gzip")]
+    since = _parse_since(" ".join(rest)) if rest else None
+    if rest and not since:
+        await update.message.reply_text("Використання: /export_users [7d | 2024-05-01] [gz]" if lang=="uk" else "Uso: /export_users [7d | 2024-05-01] [gz]"); return
+    await flush_activity()
+    spool, n = await export_csv(
+        "SELECT id, username, first_name, last_name, language_code, pref_lang, login, verified, is_bot, first_seen, last_seen, msg_count, click_count FROM users",
+        ["id","username","first_name","last_name","language_code","pref_lang","login","verified","is_bot","first_seen","last_seen","msg_count","click_count"],
+        where="(last_seen >= ? OR updated_at >= ?)" if since else "", params=(since, since) if since else (), gz=gz)
+    with spool:
+        name = "users_export" + (f"_since_{since[:10]}" if since else "") + (".csv.gz" if gz else ".csv")
+        caption = ("Експорт" if lang=="uk" else "Export") + f": {n}" + (f" (since {since} UTC)" if since else "")
+        await update.message.reply_document(document=InputFile(spool, filename=name, read_file_handle=False), caption=caption)
+
+async def cmd_export_forms(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    uid = update.effective_user.id
+    lang = await get_pref_lang(uid)
+    if not is_admin(uid):
+        await update.message.reply_text("⛔ Недостатньо прав (лише для адміністраторів)." if lang=="uk" else "⛔ Sin permisos (solo para administradores)."); return
+    # /export_forms <form_key> [since] [until] [gz]: 7d или дата UTC; until — голая дата включительно
+    gz = any(a.lower() in ("gz", "gzip") for a in context.args)
+    rest = [a for a in context.args if a.lower() not in ("gz", "gzip")]
+    usage = ("Використання: " if lang=="uk" else "Uso: ") + "/export_forms <form_key> [7d | 2024-05-01] [2024-05-31] [gz]"
+    if not rest or len(rest) > 3:
+        counts = await db_fetchall("SELECT form_key, COUNT(*) FROM form_submissions GROUP BY form_key ORDER BY form_key")
+        keys = "\n".join(f"• {k} — {n}" for k, n in counts)
+        await update.message.reply_text(usage + (f"\n\n{keys}" if keys else "")); return
+    form_key = rest[0]
+    since = _parse_since(rest[1]) if len(rest) > 1 else None
+    until = _parse_until(rest[2]) if len(rest) > 2 else None
+    if (len(rest) > 1 and not since) or (len(rest) > 2 and not until):
+        await update.message.reply_text(usage); return
+    spool, n = await export_forms_csv(form_key, lang, since, until, gz=gz)
+    with spool:
+        safe_key = re.sub(r"[^\w-]+", "_", form_key)
+        name = (f"form_{safe_key}" + (f"_since_{since[:10]}" if since else "") + (f"_until_{until[:10]}" if until else "")
+                + (".csv.gz" if gz else ".csv"))
+        caption = f"{form_key}: {n}" + (f" [{since or '…'} — {until or '…'}) UTC" if since or until else "")
+        await update.message.reply_document(document=InputFile(spool, filename=name, read_file_handle=False), caption=caption)
 
 async def cmd_setprofile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
@@ -1191,6 +2613,30 @@ async def cmd_setprofile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.message.reply_text(("✅ Профіль збережено: " if lang=="uk" else "✅ Perfil guardado: ") + login,
                                     reply_markup=await kb_main_for(uid))
 
+def _int_field(row: dict, name: str) -> int:
+    v = (row.get(name) or "").strip()
+    try:
+        return int(v) if v else 0
+    except ValueError:
+        raise ValueError(f"{name}={v[:40]!r} is not an integer") from None
+
+def _profile_from_import_row(r: dict) -> dict:
+    login = (r.get("login") or "").strip()
+    if not login:
+        raise ValueError("empty login")
+    return {
+        "login": login,
+        "full_name": _clean_text(r.get("full_name") or ""),
+        "position":  _clean_text(r.get("position")  or ""),
+        "team":      _clean_text(r.get("team") or r.get("department") or ""),
+        "email":     (r.get("email") or "").strip(),
+        "phone":     (r.get("phone") or "").strip(),
+        "manager":   _clean_text(r.get("manager") or ""),
+        "vacation_left": _int_field(r, "vacation_left"),
+        "salary_usd":    _int_field(r, "salary_usd"),
+        "extra_json": None
+    }
+
 async def cmd_import_profiles(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
     lang = await get_pref_lang(uid)
@@ -1198,31 +2644,55 @@ async def cmd_import_profiles(update: Update, context: ContextTypes.DEFAULT_TYPE
         await update.message.reply_text("⛔ Недостатньо прав (лише для адміністраторів)." if lang=="uk" else "⛔ Sin permisos (solo para administradores)."); return
     if not update.message.document:
         await update.message.reply_text("Прикріпіть CSV (login, ...)" if lang=="uk" else "Adjunta un CSV con perfiles (login, ...)."); return
+    progress = await update.message.reply_text("⏳ Імпорт…" if lang=="uk" else "⏳ Importando…")
     file = await context.bot.get_file(update.message.document.file_id)
-    data = await file.download_as_bytearray()
-    text = data.decode("utf-8-sig", errors="ignore")
-    reader = csv.DictReader(io.StringIO(text))
-    rows = list(reader); count = 0
-    batch: Dict[str, dict] = {}
-    for r in rows:
-        login = (r.get("login") or "").strip()
-        if not login: continue
-        batch[login] = {
-            "login": login,
-            "full_name": _clean_text(r.get("full_name") or ""),
-            "position":  _clean_text(r.get("position")  or ""),
-            "team":      _clean_text(r.get("team") or r.get("department") or ""),
-            "email":     (r.get("email") or "").strip(),
-            "phone":     (r.get("phone") or "").strip(),
-            "manager":   _clean_text(r.get("manager") or ""),
-            "vacation_left": int((r.get("vacation_left") or "0").strip() or 0),
-            "salary_usd":   int((r.get("salary_usd") or "0").strip() or 0),
-            "extra_json": None
-        }
-        count += 1
-    await upsert_profiles(batch)
-    await update.message.reply_text(("✅ Імпортовано: " if lang=="uk" else "✅ Importados: ") + str(count),
-                                    reply_markup=await kb_main_for(uid))
+    spool = tempfile.SpooledTemporaryFile(max_size=SHEET_SPOOL_MAX)
+    good = bad = dup = saved = 0   # saved — строки, уже записанные в БД
+    errors: List[str] = []   # первые IMPORT_ERRORS_SHOWN, остальные только считаются
+    last_edit = time.monotonic()
+    try:
+        await file.download_to_memory(out=spool)
+        spool.seek(0)
+        reader = csv.DictReader(io.TextIOWrapper(spool, encoding="utf-8-sig", errors="replace", newline=""))
+        batch: Dict[str, dict] = {}
+        for r in reader:
+            try:
+                p = _profile_from_import_row(r)
+                # повтор логина в пределах чанка перезаписывает строку (и считается отдельно);
+                # между чанками — просто ещё один upsert, память на весь файл не держим
+                if p["login"] in batch:
+                    dup += 1
+                else:
+                    good += 1
+                batch[p["login"]] = p
+            except ValueError as e:
+                bad += 1
+                if len(errors) < IMPORT_ERRORS_SHOWN:
+                    errors.append(f"#{reader.line_num}: {e}")
+            if len(batch) >= IMPORT_CHUNK:
+                await upsert_profiles(batch)
+                saved += len(batch); batch = {}
+                if time.monotonic() - last_edit >= IMPORT_PROGRESS_SEC:
+                    last_edit = time.monotonic()
+                    with contextlib.suppress(Exception):
+                        await progress.edit_text(("⏳ Імпорт… ✅ {g} ❌ {b}" if lang=="uk" else "⏳ Importando… ✅ {g} ❌ {b}").format(g=good, b=bad))
+        await upsert_profiles(batch)
+        saved += len(batch)
+    except Exception as e:
+        log.error(f"[import] failed after {saved} saved rows: {e}")
+        await progress.edit_text((f"❌ Імпорт перервано ({e}). Збережено: {saved}" if lang=="uk" else f"❌ Importación interrumpida ({e}). Guardados: {saved}"))
+        return
+    finally:
+        spool.close()
+
+    summary = ("✅ Імпортовано: {g}\n❌ З помилками: {b}" if lang=="uk" else "✅ Importados: {g}\n❌ Con errores: {b}").format(g=good, b=bad)
+    if dup:
+        summary += ("\n🔁 Повторні логіни (діє останній рядок): {d}" if lang=="uk" else "\n🔁 Logins repetidos (vale la última fila): {d}").format(d=dup)
+    if errors:
+        summary += "\n\n" + "\n".join(errors)
+        if bad > len(errors):
+            summary += f"\n… +{bad - len(errors)}"
+    await progress.edit_text(summary, reply_markup=await kb_main_for(uid))
 
 async def cmd_dump_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
@@ -1248,39 +2718,516 @@ async def cmd_dump_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
     await update.message.reply_html(txt)
 
+# ---- /profile: профилирование по запросу ----
+# cProfile включается только на окно замера и только в потоке event loop — там идут все
+# хендлеры; вне окна накладных расходов нет. Запросы к БД выполняются в потоках aiosqlite и
+# видны как ожидание. Из сводки убраны внутренности asyncio / selectors (в т.ч. простой в poll),
+# в .prof они есть — он открывается pstats / snakeviz.
+_PROFILE_TASK: Optional[asyncio.Task] = None
+
+def _profile_internal(fn: str, name: str) -> bool:
+    return (f"{os.sep}asyncio{os.sep}" in fn or fn.endswith(f"{os.sep}selectors.py")
+            or (fn == "~" and ("select." in name or "_contextvars.Context" in name)))
+
+def _profile_summary(stats: dict, seconds: float) -> str:
+    busy = sum(tt for (fn, _, name), (_, _, tt, _, _) in stats.items() if not (fn == "~" and "select." in name))
+    calls = sum(nc for _, nc, _, _, _ in stats.values())
+    rows = sorted(((ct, tt, nc, fn, line, name) for (fn, line, name), (_, nc, tt, ct, _) in stats.items()
+                   if not _profile_internal(fn, name)), reverse=True)[:PROFILE_TOP]
+    lines = [f"{ct:7.3f} {tt:7.3f} {nc:>7}  {name} ({os.path.basename(fn)}:{line})" if line else f"{ct:7.3f} {tt:7.3f} {nc:>7}  {name}"
+             for ct, tt, nc, fn, line, name in rows]
+    head = f"window {seconds:.0f}s, loop busy {busy:.2f}s ({100 * busy / max(seconds, 1e-9):.0f}%), {calls} calls\n"
+    return head + "cumtime  tottime   ncalls  function\n" + "\n".join(lines)
+
+async def _run_profile(bot, chat_id: int, seconds: int, lang: str):
+    prof = cProfile.Profile()
+    try:
+        prof.enable()
+    except ValueError as e:   # уже работает другой профайлер (sys.monitoring в 3.12+)
+        await bot.send_message(chat_id, f"⚠️ {e}"); return
+    t0 = time.perf_counter()
+    try:
+        await asyncio.sleep(seconds)
+    finally:
+        prof.disable()
+    elapsed = time.perf_counter() - t0
+    try:
+        prof.create_stats()
+        summary, dump = await asyncio.to_thread(lambda: (_profile_summary(prof.stats, elapsed), marshal.dumps(prof.stats)))
+        name = time.strftime("profile_%Y%m%d_%H%M%S.prof", time.gmtime())
+        body = summary if len(summary) <= 3900 else summary[:3900].rsplit("\n", 1)[0] + "\n…"
+        await bot.send_message(chat_id, f"<pre>{html.escape(body)}</pre>", parse_mode="HTML")
+        await bot.send_document(chat_id, document=InputFile(io.BytesIO(dump), filename=name),
+                                caption=("Відкрити: " if lang=="uk" else "Abrir: ") + f"python -m pstats {name}")
+        log.info(f"[profile] {elapsed:.0f}s window sent to {chat_id}")
+    except Exception as e:
+        log.error(f"[profile] report failed: {e}")
+
+async def cmd_profile(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    global _PROFILE_TASK
+    uid = update.effective_user.id
+    lang = await get_pref_lang(uid)
+    if not is_admin(uid):
+        await update.message.reply_text("⛔ Недостатньо прав (лише для адміністраторів)." if lang=="uk" else "⛔ Sin permisos (solo para administradores)."); return
+    try:
+        seconds = int(context.args[0]) if context.args else PROFILE_DEFAULT_SEC
+    except ValueError:
+        seconds = 0
+    if not 1 <= seconds <= PROFILE_MAX_SEC:
+        await update.message.reply_text(("Використання: " if lang=="uk" else "Uso: ") + f"/profile [1..{PROFILE_MAX_SEC}]"); return
+    if _PROFILE_TASK and not _PROFILE_TASK.done():
+        await update.message.reply_text("⏳ Профілювання вже йде." if lang=="uk" else "⏳ Ya hay un perfilado en curso."); return
+    # окно замера — в фоне: хендлер сразу освобождает очередь апдейтов админа
+    _PROFILE_TASK = asyncio.create_task(_run_profile(context.bot, update.effective_chat.id, seconds, lang))
+    await update.message.reply_text(f"⏱ Профілювання {seconds} с… (на цей час бот працює повільніше)" if lang=="uk"
+                                    else f"⏱ Perfilando {seconds} s… (mientras tanto el bot va más lento)")
+
 # ---- /refresh и автосинк ----
-async def load_from_sheet_once():
-    global KB_ES, KB_UK, FORMS_ES, FORMS_UK
+# Синки (автосинк, /refresh от разных админов) идут строго по одному: у них общие
+# _TAB_STATE, TEMP-таблица profile_stage и версия снимка CONTENT.
+_SHEET_SYNC_LOCK = asyncio.Lock()
+
+async def load_from_sheet_once(force: bool = False):
+    """(ok, err, kept): kept — сколько пропавших логинов защита оставила до /refresh force."""
+    async with _SHEET_SYNC_LOCK:
+        return await _load_from_sheet_locked(force)
+
+async def _load_from_sheet_locked(force: bool = False):
+    global CONTENT
+    t0 = time.perf_counter()
     try:
-        KB_es, KB_uk, FR_es, FR_uk, PROFILES = await fetch_sheet_configs()
-        KB_ES.clear(); KB_ES.update(KB_es)
-        KB_UK.clear(); KB_UK.update(KB_uk)
-        FORMS_ES.clear(); FORMS_ES.update(FR_es)
-        FORMS_UK.clear(); FORMS_UK.update(FR_uk)
-        await upsert_profiles(PROFILES)
-        log.info(f"[gsheet] loaded: KB_es={len(KB_ES)} KB_uk={len(KB_UK)} FORMS_es={len(FORMS_ES)} FORMS_uk={len(FORMS_UK)} PROFILES={len(PROFILES)}")
-        return True, ""
+        res = await fetch_sheet_configs(force)
+        if res is None:
+            SHEET_SYNC_SECONDS.observe(time.perf_counter() - t0, "unchanged")
+            log.info(f"[gsheet] no changes, keeping v{CONTENT.version}")
+            return True, "", 0
+        KB_es, KB_uk, FR_es, FR_uk, counts, tab_states = res
+        prev = CONTENT
+        kb, forms = {"es": KB_es, "uk": KB_uk}, {"es": FR_es, "uk": FR_uk}
+        if kb != prev.kb or forms != prev.forms:
+            # индексы и клавиатуры собираются вне event loop; подмена — одно присваивание
+            CONTENT = await asyncio.to_thread(ContentSnapshot, prev.version + 1, kb, forms, prev)
+        _TAB_STATE.update(tab_states)
+        SHEET_SYNC_SECONDS.observe(time.perf_counter() - t0, "ok")
+        log.info(f"[gsheet] loaded v{CONTENT.version}: KB_es={len(KB_es)} KB_uk={len(KB_uk)} FORMS_es={len(FR_es)} FORMS_uk={len(FR_uk)} profiles={counts}")
+        return True, "", counts["kept"]
     except Exception as e:
+        SHEET_SYNC_SECONDS.observe(time.perf_counter() - t0, "error")
         log.error(f"[gsheet] load error: {e}")
-        return False, str(e)
+        return False, str(e), 0
 
 async def cmd_refresh(update: Update, context: ContextTypes.DEFAULT_TYPE):
     uid = update.effective_user.id
     lang = await get_pref_lang(uid)
     if not is_admin(uid):
         await update.message.reply_text("⛔ Недостатньо прав (лише для адміністраторів)." if lang=="uk" else "⛔ Sin permisos (solo para administradores)."); return
-    ok, err = await load_from_sheet_once()
+    force = bool(context.args) and context.args[0].lower() == "force"
+    ok, err, kept = await load_from_sheet_once(force)
     if ok:
-        await update.message.reply_text("✅ Дані перезавантажено." if lang=="uk" else "✅ Datos recargados.", reply_markup=await kb_main_for(uid))
+        txt = "✅ Дані перезавантажено." if lang=="uk" else "✅ Datos recargados."
+        if kept:
+            txt += (f"\n⚠️ {kept} логінів зникли з таблиці, але не видалені (вкладка різко скоротилася). Перевірте таблицю й виконайте /refresh force."
+                    if lang=="uk" else
+                    f"\n⚠️ {kept} logins desaparecieron de la tabla pero no se eliminaron (la pestaña se redujo bruscamente). Revisa la tabla y ejecuta /refresh force.")
+        await update.message.reply_text(txt, reply_markup=await kb_main_for(uid))
     else:
         await update.message.reply_text(("❌ Помилка завантаження: " if lang=="uk" else "❌ Error al cargar: ") + err, reply_markup=await kb_main_for(uid))
 
+# ---------- persistence: user_data и диалоги в hr_forms.db ----------
+class SqlitePersistence(BasePersistence):
+    """Состояние verify / form_fill и диалог логина переживают рестарт. user_data
+    поднимается лениво, при первом апдейте пользователя (refresh_user_data), а не
+    целиком на старте. Пишутся только записи, чей JSON изменился с последней записи;
+    всё, что PTB отдал за один цикл update_persistence, уходит одной транзакцией.
+    chat_data / bot_data / callback_data бот не использует и не хранит."""
+
+    def __init__(self, update_interval: float = PERSIST_INTERVAL_SEC):
+        super().__init__(store_data=PersistenceInput(chat_data=False, bot_data=False, callback_data=False),
+                         update_interval=update_interval)
+        self._loaded: set = set()                             # user_id, чьи данные уже подняты из БД
+        self._written: Dict[int, str] = {}                    # user_id -> хэш последнего записанного JSON
+        self._pending_users: Dict[int, tuple] = {}            # user_id -> (json | None = удалить, хэш)
+        self._pending_convs: Dict[tuple, Optional[str]] = {}  # (name, key) -> json состояния | None = удалить
+        self._flush_task: Optional[asyncio.Task] = None
+        self._closing = False                                 # flush() на остановке: без повторов
+
+    # --- user_data ---
+    async def get_user_data(self) -> Dict[int, dict]:
+        return {}   # ничего не грузим заранее, см. refresh_user_data
+
+    async def refresh_user_data(self, user_id: int, user_data: dict) -> None:
+        if user_id in self._loaded:
+            return
+        await init_db()
+        row = await db_fetchone("SELECT data_json FROM bot_user_data WHERE user_id=?", (user_id,))
+        if row:
+            try:
+                for k, v in json.loads(row[0]).items():
+                    user_data.setdefault(k, v)
+            except Exception as e:
+                log.error(f"[persist] bad user_data for {user_id}: {e}")
+            self._written[user_id] = hashlib.blake2b(row[0].encode("utf-8"), digest_size=16).hexdigest()
+        self._loaded.add(user_id)
+
+    async def update_user_data(self, user_id: int, data: dict) -> None:
+        if user_id not in self._loaded:
+            return   # не поднятые из БД данные не менялись — не затираем сохранённое
+        if any(v is not None for v in data.values()):
+            raw = json.dumps(data, ensure_ascii=False, sort_keys=True, default=str)
+            digest = hashlib.blake2b(raw.encode("utf-8"), digest_size=16).hexdigest()
+        else:
+            raw, digest = None, ""
+        if self._written.get(user_id, "") == digest:
+            self._pending_users.pop(user_id, None)
+            return
+        self._pending_users[user_id] = (raw, digest)
+        self._schedule_flush()
+
+    async def drop_user_data(self, user_id: int) -> None:
+        self._pending_users[user_id] = (None, "")
+        self._loaded.discard(user_id)
+        self._schedule_flush()
+
+    # --- ConversationHandler ---
+    async def get_conversations(self, name: str) -> dict:
+        await init_db()   # Application.initialize() читает persistence раньше post_init
+        rows = await db_fetchall("SELECT conv_key, state FROM bot_conversations WHERE name=?", (name,))
+        return {tuple(json.loads(k)): json.loads(st) for k, st in rows}
+
+    async def update_conversation(self, name: str, key: tuple, new_state: Optional[object]) -> None:
+        self._pending_convs[(name, json.dumps(list(key)))] = None if new_state is None else json.dumps(new_state)
+        self._schedule_flush()
+
+    # --- запись ---
+    def _schedule_flush(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_pending())
+
+    async def _flush_pending(self):
+        await asyncio.sleep(0)   # дать update_persistence сложить все изменения этого цикла
+        # пока идёт запись, приходят новые изменения, а неудачная возвращается в буфер — задача
+        # не заканчивается, пока буфер не пуст; после сбоя повтор через update_interval
+        while self._pending_users or self._pending_convs:
+            if not await self._write_pending():
+                if self._closing:
+                    return
+                await asyncio.sleep(self.update_interval)
+
+    async def _write_pending(self) -> bool:
+        users, self._pending_users = self._pending_users, {}
+        convs, self._pending_convs = self._pending_convs, {}
+        try:
+            await init_db()
+            async with db_tx() as db:
+                up = [(uid, raw) for uid, (raw, _) in users.items() if raw is not None]
+                if up:
+                    await db.executemany("""
+                        INSERT INTO bot_user_data (user_id, data_json, updated_at) VALUES (?, ?, CURRENT_TIMESTAMP)
+                        ON CONFLICT(user_id) DO UPDATE SET data_json=excluded.data_json, updated_at=excluded.updated_at
+                    """, up)
+                gone = [(uid,) for uid, (raw, _) in users.items() if raw is None]
+                if gone:
+                    await db.executemany("DELETE FROM bot_user_data WHERE user_id=?", gone)
+                await db.executemany("INSERT OR REPLACE INTO bot_conversations (name, conv_key, state) VALUES (?, ?, ?)",
+                                     [(n, k, st) for (n, k), st in convs.items() if st is not None])
+                await db.executemany("DELETE FROM bot_conversations WHERE name=? AND conv_key=?",
+                                     [(n, k) for (n, k), st in convs.items() if st is None])
+            for uid, (_, digest) in users.items():
+                self._written[uid] = digest
+            return True
+        except Exception as e:
+            log.error(f"[persist] flush failed: {e}")
+            # вернуть в буфер всё, что не перезаписано более свежими изменениями
+            for uid, v in users.items():
+                self._pending_users.setdefault(uid, v)
+            for k, v in convs.items():
+                self._pending_convs.setdefault(k, v)
+            return False
+
+    async def flush(self) -> None:
+        self._closing = True
+        if self._flush_task is not None:
+            await self._flush_task
+        await self._flush_pending()
+
+    # --- не используются ---
+    async def get_chat_data(self) -> dict: return {}
+    async def get_bot_data(self) -> dict: return {}
+    async def get_callback_data(self) -> None: return None
+    async def update_chat_data(self, chat_id: int, data: dict) -> None: pass
+    async def update_bot_data(self, data: dict) -> None: pass
+    async def update_callback_data(self, data) -> None: pass
+    async def drop_chat_data(self, chat_id: int) -> None: pass
+    async def refresh_chat_data(self, chat_id: int, chat_data: dict) -> None: pass
+    async def refresh_bot_data(self, bot_data: dict) -> None: pass
+
+# ---------- параллельная обработка апдейтов ----------
+_CALLBACK_PREFIXES = ("back_to:", "formchoice_", "formfill_", "users:", "faq_", "lang_")
+_CALLBACK_EXACT = {"start_verify", "menu_quick", "menu_forms", "menu_profile"}
+_KNOWN_COMMANDS: set = set()   # заполняет build_app; прочие /слова идут в метку "other"
+
+def _update_metric_label(update: object) -> list:
+    if not isinstance(update, Update):
+        return ["other", ""]
+    if update.callback_query:
+        data = update.callback_query.data or ""
+        if data in _CALLBACK_EXACT:
+            return ["on_menu_click", data]
+        return ["on_menu_click", next((p.rstrip(":_") for p in _CALLBACK_PREFIXES if data.startswith(p)), "other")]
+    msg = update.effective_message
+    if msg and msg.web_app_data:
+        return ["webapp", ""]
+    text = (msg.text or "") if msg else ""
+    if text.startswith("/"):
+        cmd = (text[1:].split(maxsplit=1) or [""])[0].split("@", 1)[0].lower()
+        return ["command", cmd if cmd in _KNOWN_COMMANDS else "other"]
+    return ["text" if text else "other", ""]
+
+class PerUserUpdateProcessor(BaseUpdateProcessor):
+    """Апдейты разных пользователей обрабатываются параллельно (не больше
+    MAX_CONCURRENT_UPDATES сразу), апдейты одного пользователя — строго по очереди:
+    на них завязаны машины состояний verify / form_fill в user_data. Очередь
+    пользователя ждёт свою блокировку до слота обработки, так что один «шумный» чат
+    не занимает общие слоты. Семафор PTB в process_update (final) берётся раньше
+    блокировки пользователя, поэтому ему дан заведомо большой лимит, а настоящий
+    держит свой семафор _workers."""
+    __slots__ = ("_order_locks", "_workers", "limit", "pending", "in_flight")
+
+    def __init__(self, max_concurrent_updates: int):
+        super().__init__(2 ** 30)
+        self.limit = max_concurrent_updates
+        self._workers = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._order_locks: Dict[int, list] = {}   # user/chat id -> [Lock, сколько апдейтов ждут или идут]
+        self.pending = 0     # апдейты, отданные процессору и ещё не обработанные
+        self.in_flight = 0   # из них — обрабатываются прямо сейчас
+
+    async def do_process_update(self, update: object, coroutine) -> None:
+        self.pending += 1
+        try:
+            key = None
+            if isinstance(update, Update):
+                if update.effective_user:   key = update.effective_user.id
+                elif update.effective_chat: key = update.effective_chat.id
+            if key is None:
+                await self._run(update, coroutine); return
+            entry = self._order_locks.get(key)
+            if entry is None:
+                entry = self._order_locks[key] = [asyncio.Lock(), 0]
+            entry[1] += 1
+            try:
+                async with entry[0]:   # asyncio.Lock будит ждущих по FIFO — порядок прихода сохраняется
+                    await self._run(update, coroutine)
+            finally:
+                entry[1] -= 1
+                if not entry[1]:
+                    del self._order_locks[key]
+        finally:
+            self.pending -= 1
+
+    async def _run(self, update: object, coroutine) -> None:
+        async with self._workers:
+            label = _update_metric_label(update)
+            token = _METRIC_ROUTE.set(label)
+            self.in_flight += 1
+            t0 = time.perf_counter()
+            try:
+                await coroutine
+            finally:
+                self.in_flight -= 1
+                _METRIC_ROUTE.reset(token)
+                HANDLER_SECONDS.observe(time.perf_counter() - t0, *label)
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+# ---------- исходящий трафик: лимиты Bot API ----------
+class _TokenBucket:
+    """Ведро токенов с резервированием: take() сразу списывает токен и возвращает, сколько
+    подождать. Баланс уходит в минус — ждущие выстраиваются в очередь без блокировок."""
+    __slots__ = ("rate", "capacity", "tokens", "stamp")
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate, self.capacity = rate, max(1.0, capacity)
+        self.tokens, self.stamp = self.capacity, time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.stamp) * self.rate)
+        self.stamp = now
+
+    def take(self) -> float:
+        self._refill()
+        self.tokens -= 1
+        return -self.tokens / self.rate if self.tokens < 0 else 0.0
+
+    def idle(self) -> bool:
+        self._refill()
+        return self.tokens >= self.capacity
+
+class BotApiRateLimiter(BaseRateLimiter):
+    """Общее ведро на все запросы с chat_id (сообщения, правки, файлы) и ведро на каждый чат:
+    личный — RATE_CHAT_PER_SEC с запасом RATE_CHAT_BURST, группа — RATE_GROUP_PER_MIN.
+    answerCallbackQuery, getUpdates и т.п. без chat_id не ограничиваются. На 429 все исходящие
+    встают на паузу retry_after, затем запрос повторяется (до RATE_MAX_RETRIES раз)."""
+    __slots__ = ("_global", "_chats", "_paused_until", "_max_retries", "stats")
+
+    def __init__(self, global_per_sec: float = RATE_GLOBAL_PER_SEC, max_retries: int = RATE_MAX_RETRIES):
+        # общий поток без запаса: запросы идут ровно раз в 1/rate с — в любую секунду не больше лимита
+        self._global = _TokenBucket(global_per_sec, 1) if global_per_sec > 0 else None
+        self._chats: Dict[Any, _TokenBucket] = {}
+        self._paused_until = 0.0
+        self._max_retries = max_retries
+        self.stats = {"requests": 0, "throttled": 0, "throttled_sec": 0.0, "flood_waits": 0, "retried": 0, "failed": 0}
+
+    def _chat_bucket(self, chat_id) -> Optional[_TokenBucket]:
+        bucket = self._chats.get(chat_id)
+        if bucket is None:
+            if len(self._chats) > 1024:   # забыть чаты, чьё ведро уже снова полное
+                for key in [k for k, b in self._chats.items() if b.idle()]:
+                    del self._chats[key]
+            group = isinstance(chat_id, str) or chat_id < 0
+            rate = RATE_GROUP_PER_MIN / 60 if group else RATE_CHAT_PER_SEC
+            if rate <= 0:
+                return None
+            bucket = self._chats[chat_id] = _TokenBucket(rate, RATE_CHAT_BURST)
+        return bucket
+
+    async def _acquire(self, chat_id) -> float:
+        waited = 0.0
+        while (pause := self._paused_until - time.monotonic()) > 0:
+            waited += pause
+            await asyncio.sleep(pause)
+        if chat_id is not None:
+            for bucket in (self._chat_bucket(chat_id), self._global):   # сначала своя очередь, потом общий слот
+                delay = bucket.take() if bucket else 0.0
+                if delay > 0:
+                    waited += delay
+                    await asyncio.sleep(delay)
+        return waited
+
+    async def process_request(self, callback, args, kwargs, endpoint, data, rate_limit_args):
+        chat_id = data.get("chat_id")
+        with contextlib.suppress(ValueError, TypeError):
+            chat_id = int(chat_id)
+        max_retries = self._max_retries if rate_limit_args is None else rate_limit_args
+        self.stats["requests"] += 1
+        for attempt in range(max_retries + 1):
+            waited = await self._acquire(chat_id)
+            if waited:
+                self.stats["throttled"] += 1
+                self.stats["throttled_sec"] += waited
+            try:
+                return await callback(*args, **kwargs)
+            except RetryAfter as e:
+                ra = e.retry_after
+                ra = ra.total_seconds() if hasattr(ra, "total_seconds") else float(ra)
+                self.stats["flood_waits"] += 1
+                self._paused_until = max(self._paused_until, time.monotonic() + ra + 0.1)
+                if attempt >= max_retries:
+                    self.stats["failed"] += 1
+                    log.warning(f"[ratelimit] {endpoint}: 429, retry_after={ra}s, giving up after {attempt} retries")
+                    raise
+                self.stats["retried"] += 1
+                log.warning(f"[ratelimit] {endpoint}: 429, retry_after={ra}s, retry {attempt + 1}/{max_retries}")
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        if self.stats["requests"]:
+            log.info(f"[ratelimit] {self.stats}")
+
+RATE_LIMITER = BotApiRateLimiter()
+
+# ---------- служебный HTTP (health-check для балансировщика, метрики) ----------
+# Минимальный HTTP/1.1 на asyncio: GET/HEAD, одна строка запроса, ответ и закрытие.
+# Маршруты — path -> корутина, возвращающая (status, content_type, body).
+_STARTED_AT = time.time()
+_HEALTH_SERVER: Optional[asyncio.AbstractServer] = None
+
+async def _route_healthz() -> tuple:
+    try:
+        await asyncio.wait_for(db_fetchone("SELECT 1", ()), timeout=2)
+        db_ok = True
+    except Exception:
+        db_ok = False
+    body = {"status": "ok" if db_ok else "degraded", "mode": BOT_MODE, "db": db_ok,
+            "content_version": CONTENT.version, "uptime_sec": int(time.time() - _STARTED_AT),
+            "ratelimit": RATE_LIMITER.stats}
+    return (200 if db_ok else 503), "application/json", json.dumps(body).encode()
+
+EMAIL_OUTBOX_QUEUED = _Gauge("hrbot_email_outbox", "Emails waiting in the outbox", ("status",))
+RATE_LIMIT_EVENTS   = _Counter("hrbot_ratelimit_events_total", "Outbound Bot API requests by rate limiter outcome", ("event",))
+RATE_LIMIT_WAIT     = _Counter("hrbot_ratelimit_wait_seconds_total", "Time outbound requests spent throttled")
+
+async def _collect_outbox():
+    EMAIL_OUTBOX_QUEUED.values = {("pending",): 0, ("sending",): 0}
+    for status, n in await db_fetchall("SELECT status, COUNT(*) FROM email_outbox WHERE status IN ('pending', 'sending') GROUP BY status"):
+        EMAIL_OUTBOX_QUEUED.set(n, status)
+
+async def _collect_ratelimit():
+    st = RATE_LIMITER.stats
+    RATE_LIMIT_EVENTS.values = {(k,): v for k, v in st.items() if k != "throttled_sec"}
+    RATE_LIMIT_WAIT.values = {(): round(st["throttled_sec"], 6)}
+
+_METRIC_COLLECTORS.extend((_collect_outbox, _collect_ratelimit))
+
+async def _route_metrics() -> tuple:
+    return 200, "text/plain; version=0.0.4; charset=utf-8", (await render_metrics()).encode()
+
+_HTTP_ROUTES: Dict[str, Any] = {"/healthz": _route_healthz, "/metrics": _route_metrics}
+
+async def _serve_http(reader: asyncio.StreamReader, writer: asyncio.StreamWriter):
+    try:
+        parts = (await asyncio.wait_for(reader.readline(), timeout=5)).decode("latin-1").split()
+        while (await asyncio.wait_for(reader.readline(), timeout=5)) not in (b"\r\n", b"\n", b""):
+            pass   # заголовки не нужны
+        method = parts[0] if parts else ""
+        route = _HTTP_ROUTES.get(parts[1].split("?", 1)[0]) if len(parts) >= 2 else None
+        if method not in ("GET", "HEAD"):
+            status, ctype, body = 405, "text/plain", b"method not allowed\n"
+        elif route is None:
+            status, ctype, body = 404, "text/plain", b"not found\n"
+        else:
+            status, ctype, body = await route()
+        head = (f"HTTP/1.1 {status} {HTTPStatus(status).phrase}\r\nContent-Type: {ctype}\r\n"
+                f"Content-Length: {len(body)}\r\nCache-Control: no-store\r\nConnection: close\r\n\r\n")
+        writer.write(head.encode("latin-1") + (b"" if method == "HEAD" else body))
+        await writer.drain()
+    except Exception as e:
+        log.debug(f"[http] {e}")
+    finally:
+        writer.close()
+
+async def start_health_server():
+    global _HEALTH_SERVER
+    if HEALTH_PORT > 0 and _HEALTH_SERVER is None:
+        _HEALTH_SERVER = await asyncio.start_server(_serve_http, HEALTH_LISTEN, HEALTH_PORT)
+        log.info(f"[http] service HTTP on {HEALTH_LISTEN}:{HEALTH_PORT}: {', '.join(_HTTP_ROUTES)}")
+
+async def stop_health_server():
+    global _HEALTH_SERVER
+    if _HEALTH_SERVER is not None:
+        _HEALTH_SERVER.close()
+        await _HEALTH_SERVER.wait_closed()
+        _HEALTH_SERVER = None
+
 # ---------- сборка ----------
 def build_app() -> Application:
-    app = Application.builder().token(BOT_TOKEN).build()
+    processor = PerUserUpdateProcessor(MAX_CONCURRENT_UPDATES)
+    app = (Application.builder().token(BOT_TOKEN)
+           .concurrent_updates(processor)
+           .persistence(SqlitePersistence())
+           .rate_limiter(RATE_LIMITER)
+           .build())
 
     async def on_startup(_):
         await init_db()
+        start_activity_flusher()
+        start_email_worker(app.bot)
         await load_from_sheet_once()
         if SYNC_INTERVAL_MIN > 0:
             async def _auto_sync_sheet():
@@ -1292,15 +3239,30 @@ def build_app() -> Application:
                         log.error(f"[autosync] sheet error: {e}")
                     await asyncio.sleep(max(60, SYNC_INTERVAL_MIN*60))
             asyncio.create_task(_auto_sync_sheet())
+        await start_health_server()   # последним: балансировщик шлёт трафик, когда бот готов
+
+    async def on_shutdown(_):
+        await stop_health_server()
+        await close_http()
+        await stop_email_worker()
+        await stop_activity_flusher()
+        await close_db()
 
     app.post_init = on_startup
+    app.post_shutdown = on_shutdown
+
+    async def _collect_updates():
+        UPDATE_QUEUE_DEPTH.set(app.update_queue.qsize())
+        UPDATES_WAITING.set(processor.pending - processor.in_flight)
+        UPDATES_IN_FLIGHT.set(processor.in_flight)
+    _METRIC_COLLECTORS.append(_collect_updates)
 
     login_conv = ConversationHandler(
         entry_points=[CommandHandler("start", start)],
         states={LOGIN: [MessageHandler(filters.TEXT & ~filters.COMMAND, login_step)]},
         fallbacks=[CommandHandler("cancel", cancel)],
         name="login_conv",
-        persistent=False,
+        persistent=True,
     )
     app.add_handler(login_conv)
 
@@ -1316,19 +3278,38 @@ def build_app() -> Application:
     app.add_handler(CommandHandler("stats", cmd_stats))
     app.add_handler(CommandHandler("users", cmd_users))
     app.add_handler(CommandHandler("export_users", cmd_export_users))
+    app.add_handler(CommandHandler("export_forms", cmd_export_forms))
     app.add_handler(CommandHandler("setprofile", cmd_setprofile))
     app.add_handler(CommandHandler("import_profiles", cmd_import_profiles))
+    app.add_handler(CommandHandler("profile", cmd_profile))
 
     app.add_handler(CallbackQueryHandler(on_menu_click))
     app.add_handler(MessageHandler(filters.StatusUpdate.WEB_APP_DATA, handle_webapp_data))
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, free_text))
     app.add_handler(CommandHandler("cancel", cancel))
+    _KNOWN_COMMANDS.update(c for h in (*login_conv.entry_points, *login_conv.fallbacks, *app.handlers[0])
+                           for c in getattr(h, "commands", ()))
 
     return app
 
 if __name__ == "__main__":
     if not BOT_TOKEN:
         raise SystemExit("❌ BOT_TOKEN не задан. Укажи его в .env")
-    log.info("Starting HR Assistant bot…")
+    log.info(f"Starting HR Assistant bot ({BOT_MODE})…")
     app = build_app()
-    app.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=True)
+    if BOT_MODE == "webhook":
+        if not WEBHOOK_URL:
+            raise SystemExit("❌ BOT_MODE=webhook, но WEBHOOK_URL не задан. Укажи его в .env")
+        app.run_webhook(
+            listen=WEBHOOK_LISTEN,
+            port=WEBHOOK_PORT,
+            url_path=WEBHOOK_PATH,
+            webhook_url=f"{WEBHOOK_URL.rstrip('/')}/{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET or hashlib.sha256(BOT_TOKEN.encode()).hexdigest()[:32],
+            cert=WEBHOOK_CERT or None,
+            key=WEBHOOK_KEY or None,
+            allowed_updates=Update.ALL_TYPES,
+            drop_pending_updates=DROP_PENDING_UPDATES,
+        )
+    else:
+        app.run_polling(allowed_updates=Update.ALL_TYPES, drop_pending_updates=DROP_PENDING_UPDATES)
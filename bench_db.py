@@ -0,0 +1,85 @@
+# bench_db.py — микро-бенчмарк накладных расходов БД на один апдейт.
+# Сравнивает старую схему (aiosqlite.connect() на каждый запрос) с общими соединениями 5bot.py
+# на одном и том же наборе запросов.
+# Запуск: python bench_db.py [кол-во апдейтов]
+import sys, time, asyncio, tempfile, importlib.util
+from pathlib import Path
+from types import SimpleNamespace
+
+import aiosqlite
+
+BASE_DIR = Path(__file__).resolve().parent
+spec = importlib.util.spec_from_file_location("hrbot", BASE_DIR / "5bot.py")
+bot = importlib.util.module_from_spec(spec)
+spec.loader.exec_module(bot)
+
+UID = 100500
+UPDATE = SimpleNamespace(effective_user=SimpleNamespace(
+    id=UID, username="bench", first_name="Bench", last_name="User", language_code="es", is_bot=False))
+
+# Один и тот же набор запросов: то, что делает on_menu_click при переключении языка + kb_main_for
+# в исходной версии бота (без кэша и write-behind). Сравниваются только способы подключения.
+WRITES = {0, 2}
+STATEMENTS = [
+    ("UPDATE users SET last_seen=CURRENT_TIMESTAMP, click_count=click_count+1 WHERE id=?", (UID,)),
+    ("SELECT pref_lang FROM users WHERE id=?", (UID,)),
+    ("UPDATE users SET pref_lang=? WHERE id=?", ("es", UID)),
+    ("SELECT pref_lang FROM users WHERE id=?", (UID,)),
+    ("SELECT verified FROM users WHERE id=?", (UID,)),
+    ("SELECT pref_lang FROM users WHERE id=?", (UID,)),
+    ("SELECT login FROM users WHERE id=?", (UID,)),
+    ("SELECT verified FROM users WHERE id=?", (UID,)),
+]
+
+# ---- старая схема: новое соединение на каждый запрос ----
+async def legacy_update():
+    for i, (sql, params) in enumerate(STATEMENTS):
+        async with aiosqlite.connect(bot.DB_PATH.as_posix()) as db:
+            cur = await db.execute(sql, params)
+            if i in WRITES:
+                await db.commit()
+            else:
+                await cur.fetchone()
+
+# ---- новая схема: те же запросы через общие соединения 5bot.py ----
+async def shared_update():
+    for i, (sql, params) in enumerate(STATEMENTS):
+        if i in WRITES:
+            async with bot.db_tx() as db:
+                await db.execute(sql, params)
+        else:
+            await bot.db_fetchone(sql, params)
+
+# ---- для справки: хелперы бота целиком (кэш состояния, write-behind счётчики, клавиатура) ----
+async def helpers_update():
+    await bot.track_user(UPDATE, inc_click=1)
+    await bot.get_pref_lang(UID)
+    await bot.set_pref_lang(UID, "es")
+    await bot.get_pref_lang(UID)
+    await bot.is_verified(UID)
+    await bot.kb_main_for(UID)
+
+async def measure(name: str, fn, n: int) -> float:
+    for _ in range(min(20, n)):
+        await fn()
+    t0 = time.perf_counter()
+    for _ in range(n):
+        await fn()
+    per_update = (time.perf_counter() - t0) / n * 1e6
+    print(f"{name:<28} {per_update:10.1f} µs/update")
+    return per_update
+
+async def main(n: int):
+    with tempfile.TemporaryDirectory() as tmp:
+        bot.DB_PATH = Path(tmp) / "bench.db"
+        await bot.init_db()
+        await bot.track_user(UPDATE, inc_msg=1)
+        before = await measure("connect per query (old)", legacy_update, n)
+        after = await measure("shared connection (new)", shared_update, n)
+        await measure("bot helpers, for reference", helpers_update, n)
+        await bot.flush_activity()
+        await bot.close_db()
+    print(f"speedup, same queries: x{before / after:.1f}")
+
+if __name__ == "__main__":
+    asyncio.run(main(int(sys.argv[1]) if len(sys.argv) > 1 else 500))